@@ -0,0 +1,244 @@
+"""
+Benchmarks of the QA pipeline on synthetic surveys of several sizes
+"""
+
+import sys, os, time
+import platform
+import json
+
+import numpy as np
+from astropy.table import Table, MaskedColumn
+from astropy.time import Time
+
+import surveyqa.core
+import surveyqa.summary
+import surveyqa.nightly
+
+#- Survey sizes to benchmark, in years
+default_years = (1, 5, 10)
+
+def make_tiles(ntiles=16000, seed=1):
+    '''
+    Generates a synthetic tiles table with the columns of desi-tiles.fits
+
+    Options:
+        ntiles: number of tiles
+        seed: random seed
+
+    Returns astropy Table; all tiles have IN_DESI=1
+    '''
+    rand = np.random.RandomState(seed)
+    tiles = Table()
+    tiles['TILEID'] = np.arange(1, ntiles+1, dtype='i4')
+    tiles['RA'] = rand.uniform(0, 360, ntiles)
+    #- uniform on the sphere between dec -20 and +80
+    sindec = rand.uniform(np.sin(np.radians(-20)), np.sin(np.radians(80)), ntiles)
+    tiles['DEC'] = np.degrees(np.arcsin(sindec))
+    tiles['PASS'] = rand.randint(0, 8, ntiles).astype('i2')
+    tiles['IN_DESI'] = np.ones(ntiles, dtype='i2')
+    tiles['EBV_MED'] = rand.exponential(0.05, ntiles).astype('f4')
+    tiles['AIRMASS'] = rand.uniform(1.0, 2.0, ntiles).astype('f4')
+    tiles['STAR_DENSITY'] = rand.uniform(1000, 10000, ntiles).astype('f4')
+    tiles['EXPOSEFAC'] = rand.uniform(1.0, 4.0, ntiles).astype('f4')
+
+    #- DESI passes 0-3 are dark, 4 is gray and 5-7 are bright
+    program = np.array(['DARK']*4 + ['GRAY'] + ['BRIGHT']*3)
+    tiles['PROGRAM'] = program[tiles['PASS']].astype('S6')
+    obsconditions = dict(DARK=1, GRAY=2, BRIGHT=4)
+    tiles['OBSCONDITIONS'] = [obsconditions[p] for p in program[tiles['PASS']]]
+    return tiles
+
+def make_exposures(tiles, years, first_night='20191201', seed=1):
+    '''
+    Generates a synthetic exposures table with the columns of exposures.fits
+
+    Args:
+        tiles: Table of tiles, e.g. from make_tiles
+        years: length of the survey in years
+
+    Options:
+        first_night: first night as YEARMMDD
+        seed: random seed
+
+    Returns astropy Table
+
+    Each night starts with 3 arcs and 3 flats (PROGRAM='CALIB', TILEID=-1,
+    masked RA, DEC and PASS), followed by about 50 science exposures
+    of tiles taken in a random order, mostly with two exposures per tile.
+    About 20% of the nights are lost to weather.
+    '''
+    rand = np.random.RandomState(seed)
+
+    #- Nights with data; the exposures start around 7pm local time (UTC-7)
+    start = Time('{}-{}-{}'.format(first_night[0:4], first_night[4:6], first_night[6:8]))
+    days = np.arange(int(round(365.25*years)))
+    days = days[rand.uniform(size=len(days)) > 0.2]
+    nights = (start + days).strftime('%Y%m%d')
+    night_mjd = start.mjd + days + 1.06
+
+    #- Exposures per night: 6 calibrations followed by the science exposures
+    ncalib = 6
+    nscience = rand.poisson(50, len(days))
+    nexp = ncalib + nscience
+    nrows = np.sum(nexp)
+    night_of_row = np.repeat(np.arange(len(days)), nexp)
+    first_row = np.cumsum(nexp) - nexp
+    index_in_night = np.arange(nrows) - first_row[night_of_row]
+    iscalib = index_in_night < ncalib
+
+    #- Science exposures visit tiles in a random order, 1-3 times each
+    nvisits = rand.choice([1, 2, 3], p=[0.1, 0.8, 0.1], size=nrows)
+    tileorder = rand.permutation(len(tiles))
+    tilerows = np.repeat(tileorder[np.arange(nrows) % len(tiles)], nvisits)
+    tilerows = tilerows[0:np.count_nonzero(~iscalib)]
+
+    exptime = np.zeros(nrows, dtype='f4')
+    exptime[iscalib] = 10.0
+    exptime[~iscalib] = rand.uniform(300, 1000, np.count_nonzero(~iscalib))
+
+    #- Exposures follow each other with 60 seconds of overhead
+    elapsed = np.cumsum(exptime + 60.0)
+    elapsed -= elapsed[first_row][night_of_row]
+    mjd = night_mjd[night_of_row] + elapsed / 86400.0
+
+    exposures = Table()
+    exposures['EXPID'] = np.arange(nrows, dtype='i4')
+    exposures['MJD'] = mjd
+    exposures['EXPTIME'] = exptime
+    tileid = np.full(nrows, -1, dtype='i4')
+    tileid[~iscalib] = tiles['TILEID'][tilerows]
+    exposures['TILEID'] = tileid
+
+    science = ~iscalib
+    for name, low, high in [('SNR2FRAC', 0.0, 1.0), ('AIRMASS', 1.0, 2.0),
+                            ('SEEING', 0.5, 2.5), ('TRANSP', 0.1, 1.0)]:
+        col = np.zeros(nrows, dtype='f4')
+        col[science] = rand.uniform(low, high, np.count_nonzero(science))
+        exposures[name] = col
+    exposures['SKY'] = science.astype('f4')
+
+    program = np.full(nrows, 'CALIB', dtype='S6')
+    program[science] = tiles['PROGRAM'][tilerows]
+    exposures['PROGRAM'] = program
+    exposures['NIGHT'] = nights[night_of_row].astype('S8')
+    flavor = np.full(nrows, 'science', dtype='S7')
+    flavor[iscalib & (index_in_night < ncalib//2)] = 'arc'
+    flavor[iscalib & (index_in_night >= ncalib//2)] = 'flat'
+    exposures['FLAVOR'] = flavor
+
+    #- Moon phase cycles every 29.5 days
+    exposures['MOONFRAC'] = 0.5 - 0.5*np.cos(2*np.pi*(mjd - 58833.0)/29.53)
+    exposures['MOONALT'] = np.where(science, rand.uniform(-80, 80, nrows), -10.0)
+    exposures['MOONSEP'] = np.where(science, rand.uniform(1.5, 178, nrows), 90.0)
+
+    for name, dtype in [('RA', 'f8'), ('DEC', 'f8'), ('PASS', 'i2')]:
+        data = np.zeros(nrows, dtype=dtype)
+        data[science] = tiles[name][tilerows]
+        exposures[name] = MaskedColumn(data, mask=iscalib)
+
+    return exposures
+
+def _timeit(func, repeat=1):
+    '''Returns the shortest wall time in seconds of REPEAT calls of func()'''
+    times = list()
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    return min(times)
+
+def run_benchmarks(outdir, years=default_years, nnights=5, repeat=1, jobs=None):
+    '''
+    Times the main QA functions on synthetic surveys of several sizes
+
+    Args:
+        outdir: directory for the QA pages written by the benchmarks
+
+    Options:
+        years: list of survey lengths in years
+        nnights: number of nightly pages generated by the nightly.makeplots
+            and core.makeplots benchmarks; the nights with the most
+            exposures are used
+        repeat: number of times to run each benchmark; the shortest time
+            is reported
+        jobs: number of worker processes for core.makeplots
+
+    Returns list of dicts with keys years, nexposures, nnights, name and
+    seconds, one per benchmark and survey size
+    '''
+    tiles = make_tiles()
+    results = list()
+    for nyears in years:
+        exposures = make_exposures(tiles, nyears)
+        exposures = surveyqa.core.add_derived_columns(exposures)
+        print('Benchmarking {} years: {} exposures on {} nights'.format(
+            nyears, len(exposures), len(np.unique(exposures['NIGHT']))))
+
+        scaledir = os.path.join(outdir, '{}yr'.format(nyears))
+        os.makedirs(scaledir, exist_ok=True)
+
+        #- Benchmark the nights with the most exposures
+        exposures = exposures[np.argsort(exposures['NIGHT'], kind='stable')]
+        night_index = surveyqa.nightly.get_night_index(exposures)
+        nights = sorted(night_index, key=lambda n: night_index[n].start-night_index[n].stop)
+        nights = nights[0:nnights]
+
+        timings = list()
+        for name in surveyqa.summary.summary_figures:
+            timings.append(('summary.'+name, lambda name=name: surveyqa.summary.get_summary_figure(name, exposures, tiles)))
+
+        timings.append(('summary.makeplots', lambda: surveyqa.summary.makeplots(exposures, tiles, scaledir)))
+        timings.append(('nightly.makeplots', lambda: [surveyqa.nightly.makeplots(night, exposures, tiles, scaledir, night_index=night_index) for night in nights]))
+        timings.append(('core.makeplots', lambda: surveyqa.core.makeplots(exposures, tiles, scaledir, nights=nights, jobs=jobs)))
+
+        for name, func in timings:
+            seconds = _timeit(func, repeat)
+            print('{:28s} {:8.3f} s'.format(name, seconds))
+            results.append(dict(years=nyears, nexposures=len(exposures),
+                                nnights=len(night_index), name=name, seconds=seconds))
+
+    return results
+
+def write_results(filename, results):
+    '''
+    Writes benchmark RESULTS from run_benchmarks to a JSON file, along with
+    the code version, date and host that they were measured with
+    '''
+    data = dict(version=surveyqa.core.get_code_version(make_tiles()),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                host=platform.node(), results=results)
+    with open(filename, 'w') as fp:
+        json.dump(data, fp, indent=1)
+
+    print('Wrote {}'.format(filename))
+
+def read_results(filename):
+    '''
+    Returns the list of benchmark results written by write_results
+    '''
+    with open(filename) as fp:
+        return json.load(fp)['results']
+
+def compare_results(results, baseline, tolerance=1.2):
+    '''
+    Compares benchmark RESULTS to those of a BASELINE run
+
+    Args:
+        results: list of results from run_benchmarks
+        baseline: list of results from a previous run, e.g. from read_results
+
+    Options:
+        tolerance: ratio of times above which a benchmark is a regression
+
+    Returns list of (years, name, seconds, baseline_seconds) of the
+    benchmarks that are slower than tolerance*baseline
+    '''
+    previous = {(r['years'], r['name']): r['seconds'] for r in baseline}
+    regressions = list()
+    for r in results:
+        key = (r['years'], r['name'])
+        if key in previous and r['seconds'] > tolerance*previous[key]:
+            regressions.append((r['years'], r['name'], r['seconds'], previous[key]))
+
+    return regressions
@@ -0,0 +1,414 @@
+"""
+Columnar cache of the input exposures and tiles tables
+"""
+
+import sys, os, shutil, re
+import numpy as np
+import hashlib
+import json
+
+from astropy.table import Table, Column, MaskedColumn
+
+import surveyqa.core
+import surveyqa.summary
+from surveyqa.timing import stage
+
+#- Version of the layout of the cached files; increase it when changing
+#- write_columns or read_columns incompatibly
+cache_format = 1
+
+def get_code_hash():
+    '''
+    Returns a hex digest of the surveyqa source code, which computes the
+    derived columns of the cached tables
+    '''
+    h = hashlib.sha1()
+    codedir = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(os.listdir(codedir)):
+        if filename.endswith('.py'):
+            with open(os.path.join(codedir, filename), 'rb') as fx:
+                h.update(fx.read())
+
+    return h.hexdigest()
+
+def get_cache_key(filename):
+    '''
+    Returns a key that changes whenever FILENAME is modified, or the cache
+    format or the surveyqa code changes
+
+    Args:
+        filename: path to an input file
+
+    The key is derived from the absolute path, size and modification time
+    of the file, so computing it doesn't require reading the file.  The
+    code is included since the cached tables have columns derived by it.
+    '''
+    info = os.stat(filename)
+    key = '{}:{}:{}:{}:{}'.format(os.path.abspath(filename), info.st_size, info.st_mtime_ns,
+                                  cache_format, get_code_hash())
+    return hashlib.sha1(key.encode()).hexdigest()[0:12]
+
+def write_columns(table, dirname):
+    '''
+    Writes each column of TABLE to dirname/COLUMN.npy
+
+    Args:
+        table: astropy Table
+        dirname: directory to write; created if needed
+
+    Masks of masked columns are written to dirname/COLUMN.mask.npy, and
+    the column order and units to dirname/columns.json, which is written
+    last so that an interrupted write is not mistaken for a valid cache.
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    columns = list()
+    for name in table.colnames:
+        col = table[name]
+        np.save(os.path.join(dirname, name+'.npy'), np.ma.getdata(col))
+        masked = bool(np.any(np.ma.getmaskarray(col)))
+        if masked:
+            np.save(os.path.join(dirname, name+'.mask.npy'), np.ma.getmaskarray(col))
+
+        unit = None if col.unit is None else col.unit.to_string()
+        columns.append(dict(name=name, masked=masked, unit=unit))
+
+    with open(os.path.join(dirname, 'columns.json'), 'w') as fp:
+        json.dump(columns, fp, indent=1)
+
+def read_columns(dirname):
+    '''
+    Reads a table written by write_columns, memory-mapping the column data
+
+    Args:
+        dirname: directory written by write_columns
+
+    Returns astropy Table
+    '''
+    with open(os.path.join(dirname, 'columns.json')) as fp:
+        columns = json.load(fp)
+
+    cols = list()
+    for c in columns:
+        data = np.load(os.path.join(dirname, c['name']+'.npy'), mmap_mode='r')
+        if c['masked']:
+            mask = np.load(os.path.join(dirname, c['name']+'.mask.npy'))
+            cols.append(MaskedColumn(data, name=c['name'], mask=mask, unit=c['unit'], copy=False))
+        else:
+            cols.append(Column(data, name=c['name'], unit=c['unit'], copy=False))
+
+    return Table(cols, copy=False)
+
+def read_cached(filename, cachedir, prepare):
+    '''
+    Reads a FITS table through a columnar cache
+
+    Args:
+        filename: input FITS file
+        cachedir: directory holding the cached tables
+        prepare: function that takes the table read from FILENAME and
+            returns the table to cache, e.g. with rows filtered and
+            derived columns added
+
+    Returns astropy Table; prepare(Table.read(filename)) if the cache is
+    missing or out of date, and the cached (memory-mapped) copy otherwise
+    '''
+    basename = os.path.basename(filename)
+    dirname = os.path.join(cachedir, '{}-{}'.format(basename, get_cache_key(filename)))
+    if os.path.isfile(os.path.join(dirname, 'columns.json')):
+        print('Reading cached {}'.format(dirname))
+        with stage('read_cache'):
+            return read_columns(dirname)
+
+    with stage('read_fits'):
+        table = Table.read(filename)
+    table = prepare(table)
+
+    #- Remove caches of previous versions of this file, but not e.g. the
+    #- exposures store when the file is named "exposures"
+    if os.path.isdir(cachedir):
+        pattern = re.compile(re.escape(basename) + '-[0-9a-f]{12}$')
+        for d in os.listdir(cachedir):
+            if pattern.match(d):
+                shutil.rmtree(os.path.join(cachedir, d), True)
+
+    write_columns(table, dirname)
+    print('Wrote cache {}'.format(dirname))
+
+    return table
+
+def _write_json(filename, data):
+    '''Writes DATA to the JSON file FILENAME, replacing it atomically'''
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as fp:
+        json.dump(data, fp, indent=1)
+    os.replace(tmpfile, filename)
+
+def concatenate(tables):
+    '''
+    Concatenates tables with the same columns, e.g. the chunks of a store;
+    faster than astropy vstack since the columns are known to match
+
+    Returns astropy Table; this is the table itself if only one is given, so
+    that e.g. a single memory-mapped chunk is not copied
+    '''
+    if len(tables) == 1:
+        return tables[0]
+
+    cols = list()
+    for name in tables[0].colnames:
+        parts = [t[name] for t in tables]
+        data = np.concatenate([np.ma.getdata(c) for c in parts])
+        unit = parts[0].unit
+        if any(isinstance(c, MaskedColumn) for c in parts):
+            mask = np.concatenate([np.ma.getmaskarray(c) for c in parts])
+            cols.append(MaskedColumn(data, name=name, mask=mask, unit=unit, copy=False))
+        else:
+            cols.append(Column(data, name=name, unit=unit, copy=False))
+
+    return Table(cols, copy=False)
+
+def _read_stats(filename):
+    '''Returns (tile_stats, nightly_stats) saved by _write_stats'''
+    tile_stats, nightly_stats = dict(), dict()
+    with np.load(filename) as data:
+        for key in data.files:
+            kind, name = key.split('.', 1)
+            if kind == 'tile':
+                tile_stats[name] = data[key]
+            else:
+                nightly_stats[name] = data[key]
+
+    return tile_stats, nightly_stats
+
+def _write_stats(filename, tile_stats, nightly_stats):
+    '''Saves the per-tile and per-night aggregates of a store to FILENAME'''
+    data = dict()
+    for name, value in tile_stats.items():
+        data['tile.'+name] = value
+    for name, value in nightly_stats.items():
+        data['night.'+name] = value
+    np.savez(filename, **data)
+
+def _read_chunks(dirname, store):
+    '''Returns the list of (memory-mapped) chunk Tables of a store'''
+    return [read_columns(os.path.join(dirname, chunk['name'])) for chunk in store['chunks']]
+
+def read_store(dirname):
+    '''
+    Reads an exposures store written by append_exposures
+
+    Args:
+        dirname: directory of the store
+
+    Returns (chunks, tile_stats, nightly_stats): the list of memory-mapped
+    Tables of the stored exposures, in the order they were appended (see
+    concatenate to combine them), and the per-tile and per-night aggregates
+    of their concatenation (see surveyqa.summary.get_tile_stats and
+    surveyqa.summary.get_nightly_stats); (None, None, None) if there is no
+    store in DIRNAME
+    '''
+    storefile = os.path.join(dirname, 'store.json')
+    if not os.path.isfile(storefile):
+        return None, None, None
+
+    with open(storefile) as fp:
+        store = json.load(fp)
+
+    tile_stats, nightly_stats = _read_stats(os.path.join(dirname, store['stats']))
+    return _read_chunks(dirname, store), tile_stats, nightly_stats
+
+def _max_expid(chunks):
+    '''Returns the largest EXPID of the chunks of a store'''
+    return max([np.max(chunk['EXPID']) for chunk in chunks])
+
+def _compact_store(dirname, store):
+    '''
+    Merges the newest chunks of a store while the last chunk is at least as
+    large as the one before it, so that a store of N appends has O(log N)
+    chunks and each row is rewritten O(log N) times
+
+    Args:
+        dirname: directory of the store
+        store: dict of store.json, updated in place
+    '''
+    chunks = store['chunks']
+    while len(chunks) >= 2 and chunks[-1]['nrows'] >= chunks[-2]['nrows']:
+        merged = concatenate([read_columns(os.path.join(dirname, chunk['name']))
+                              for chunk in chunks[-2:]])
+        name = 'chunk-{:06d}'.format(store['next'])
+        write_columns(merged, os.path.join(dirname, name))
+        old = chunks[-2:]
+        chunks[-2:] = [dict(name=name, nrows=len(merged))]
+        store['next'] += 1
+        _write_json(os.path.join(dirname, 'store.json'), store)
+        for chunk in old:
+            shutil.rmtree(os.path.join(dirname, chunk['name']), True)
+
+def read_new_exposures(filename, cachedir):
+    '''
+    Reads the exposures of a FITS file that are not yet in the exposures
+    store of CACHEDIR (see append_exposures)
+
+    Args:
+        filename: input exposures FITS file
+        cachedir: directory holding the store (cachedir/exposures-store)
+
+    Returns astropy Table of the rows with EXPID greater than the largest
+    EXPID in the store (all rows if there is no store)
+
+    The FITS file is memory-mapped and only the new rows are copied, so
+    that the history already in the store is not read into memory.
+    '''
+    chunks, tile_stats, nightly_stats = read_store(os.path.join(cachedir, 'exposures-store'))
+    with stage('read_fits'):
+        exposures = Table.read(filename, memmap=True)
+        if chunks is None:
+            return Table(exposures, copy=True)
+        else:
+            return exposures[exposures['EXPID'] > _max_expid(chunks)]
+
+def append_exposures(new_exposures, cachedir):
+    '''
+    Appends new exposures to a persistent columnar exposures store, so that
+    exposures arriving during the night can be added without re-reading
+    the full history from FITS
+
+    Args:
+        new_exposures: Table of exposures, e.g. from read_new_exposures;
+            only rows with EXPID greater than the largest EXPID already in
+            the store are added
+        cachedir: directory holding the store (cachedir/exposures-store)
+
+    Returns (chunks, added): the list of memory-mapped Tables of all the
+    stored exposures (with derived columns, see
+    surveyqa.core.add_derived_columns), which concatenate combines into the
+    full table, and the rows that were added by this call; chunks is None
+    if nothing was ever stored
+
+    The added rows are written as a new chunk of column files next to the
+    previous ones, and the per-tile and per-night aggregates saved with the
+    store (see read_store) are updated from the added rows and the stored
+    rows of the nights they belong to, so that an append doesn't rewrite,
+    regroup or load the full history.  store.json, which lists the chunks
+    and the aggregates file, is replaced last so that an interrupted append
+    leaves the previous store intact.
+    '''
+    dirname = os.path.join(cachedir, 'exposures-store')
+    chunks, tile_stats, nightly_stats = read_store(dirname)
+    if chunks is not None:
+        keep = new_exposures['EXPID'] > _max_expid(chunks)
+        added = new_exposures[keep]
+    else:
+        added = new_exposures
+
+    if len(added) == 0:
+        return chunks, added
+
+    added = _prepare_exposures(added)
+    if chunks is None:
+        #- Remove what's left of an interrupted first append
+        shutil.rmtree(dirname, True)
+        os.makedirs(dirname)
+        store = dict(chunks=list(), next=0, stats=None)
+        tile_stats = surveyqa.summary.get_tile_stats(added)
+        nightly_stats = surveyqa.summary.get_nightly_stats(added)
+    else:
+        with open(os.path.join(dirname, 'store.json')) as fp:
+            store = json.load(fp)
+        colnames = chunks[0].colnames
+        if set(added.colnames) != set(colnames):
+            raise ValueError('Columns of the new exposures {} do not match the stored columns {}'.format(
+                added.colnames, colnames))
+        added = added[colnames]
+        offset = sum([len(chunk) for chunk in chunks])
+
+        #- Per-tile aggregates merge with those of the added rows; nightly
+        #- medians are recomputed for the nights of the added rows only,
+        #- from just the stored rows of those nights
+        new_stats = surveyqa.summary.get_tile_stats(added)
+        new_stats['FIRST_ROW'] += offset
+        new_stats['LAST_ROW'] += offset
+        tile_stats = surveyqa.summary.update_tile_stats(tile_stats, new_stats)
+        nights = np.unique(added['NIGHT'])
+        updated = concatenate([chunk[np.isin(chunk['NIGHT'], nights)] for chunk in chunks] + [added])
+        nightly_stats = surveyqa.summary.update_nightly_stats(nightly_stats, updated)
+
+    name = 'chunk-{:06d}'.format(store['next'])
+    write_columns(added, os.path.join(dirname, name))
+    statsfile = 'stats-{:06d}.npz'.format(store['next'])
+    _write_stats(os.path.join(dirname, statsfile), tile_stats, nightly_stats)
+
+    oldstats = store['stats']
+    store['chunks'].append(dict(name=name, nrows=len(added)))
+    store['next'] += 1
+    store['stats'] = statsfile
+    _write_json(os.path.join(dirname, 'store.json'), store)
+    if oldstats is not None:
+        os.remove(os.path.join(dirname, oldstats))
+
+    _compact_store(dirname, store)
+    print('Added {} exposures to {}'.format(len(added), dirname))
+
+    return _read_chunks(dirname, store), added
+
+def read_exposure_stats(cachedir):
+    '''
+    Returns (tile_stats, nightly_stats), the per-tile and per-night
+    aggregates of the exposures store in CACHEDIR kept up to date by
+    append_exposures, or (None, None) if there is no store
+    '''
+    dirname = os.path.join(cachedir, 'exposures-store')
+    storefile = os.path.join(dirname, 'store.json')
+    if not os.path.isfile(storefile):
+        return None, None
+
+    with open(storefile) as fp:
+        store = json.load(fp)
+
+    return _read_stats(os.path.join(dirname, store['stats']))
+
+def _prepare_exposures(exposures):
+    '''Returns the exposures with the derived columns added'''
+    return surveyqa.core.add_derived_columns(exposures)
+
+def _prepare_tiles(tiles):
+    '''Returns the tiles with IN_DESI>0'''
+    return tiles[tiles['IN_DESI']>0]
+
+def read_exposures(filename, cachedir=None):
+    '''
+    Reads the exposures table with derived columns HOURANGLE and TIME
+
+    Args:
+        filename: input exposures FITS file
+
+    Options:
+        cachedir: if not None, directory of the columnar cache to use
+
+    Returns astropy Table
+    '''
+    if cachedir is None:
+        with stage('read_fits'):
+            exposures = Table.read(filename)
+        return _prepare_exposures(exposures)
+    else:
+        return read_cached(filename, cachedir, _prepare_exposures)
+
+def read_tiles(filename, cachedir=None):
+    '''
+    Reads the tiles table, keeping only the tiles with IN_DESI>0
+
+    Args:
+        filename: input tiles FITS file
+
+    Options:
+        cachedir: if not None, directory of the columnar cache to use
+
+    Returns astropy Table
+    '''
+    if cachedir is None:
+        with stage('read_fits'):
+            tiles = Table.read(filename)
+        return _prepare_tiles(tiles)
+    else:
+        return read_cached(filename, cachedir, _prepare_tiles)
@@ -2,56 +2,250 @@
 Core functions for DESI survey quality assurance (QA)
 """
 
-import sys, os, shutil
+import sys, os, shutil, time
 import numpy as np
 import re
 from os import walk
 import bokeh
+import bokeh.settings
+from bokeh.util.paths import bokehjsdir
 import urllib.request
+import hashlib
+import pickle
+import tempfile
+import functools
+from astropy.table import Table
 
 import surveyqa.summary
 import surveyqa.nightly
+import surveyqa.timing
+from surveyqa.timing import stage
 from pathlib import PurePath
 import json
 
 import multiprocessing as mp
+import multiprocessing.pool
+import concurrent.futures
+
+#- Inputs shared by all tasks of a worker process; see _init_worker
+_worker_inputs = dict()
+
+def _init_worker(inputs):
+    '''
+    Pool initializer of the worker processes that stores the inputs shared
+    by every task, so that each task only needs to be sent its night or
+    summary figure name.  Tasks run in threads of the calling process are
+    given the inputs directly instead (see _get_inputs), so that the
+    settings of the calling process are left alone.
+
+    Running the initializer imports surveyqa (and with it bokeh and
+    astropy) when the worker starts rather than in its first task.  With
+    the fork start method (Linux default) the tables are inherited by the
+    worker processes instead of being pickled; otherwise they are pickled
+    once per worker rather than once per task.
+
+    Args:
+        inputs: dict with keys
+            exposures: Table of exposures passed to surveyqa.nightly.makeplots
+            tiles: Table of tile locations
+            outdir: directory to write the files
+            night_index: dict of slices into exposures keyed by night, from
+                surveyqa.nightly.get_night_index
+            moonlocs: dict of moon (ra, dec) keyed by night, from
+                surveyqa.nightly.get_moonlocs
+            survey_hists: dict of histograms of all exposures, from
+                surveyqa.nightly.get_survey_hists
+            external_data: passed to surveyqa.nightly.makeplots
+            single_page: if True, write the data bundles of the single page
+                dashboard instead of the nightly pages, and link the summary
+                table to the dashboard
+            summary_exposures: Table of exposures for the summary page
+            summary_tile_stats: per-tile aggregates of summary_exposures,
+                from surveyqa.summary.get_tile_stats
+            tile_index: index of tiles by TILEID, from
+                surveyqa.summary.get_tile_index
+            summary_nightly_stats: per-night aggregates of summary_exposures,
+                from surveyqa.summary.get_nightly_stats, or None to compute
+                them with the summary table
+            full_progress: passed to surveyqa.summary.get_summary_components
+            raster_sky: passed to surveyqa.nightly.makeplots and
+                surveyqa.summary.get_summary_components
+            timing: if True, record stage timings (see surveyqa.timing)
+    '''
+    _worker_inputs.clear()
+    _worker_inputs.update(inputs)
+    surveyqa.timing.enable(inputs.get('timing', False))
+
+    #- The figures of the summary page are built in different workers, but
+    #- bokeh's default ids count up from 1001 in each process, so the ids of
+    #- models from different workers would collide in summary.html
+    bokeh.settings.settings.simple_ids.set_value(False)
+
+def _load_worker_inputs(inputsfile):
+    '''
+    Makes sure that this worker holds the inputs pickled to INPUTSFILE,
+    loading them only on the first task of a run.  This is used for pools
+    passed in by the caller, whose initializer can't be set by makeplots.
+
+    Args:
+        inputsfile: pickle file of the inputs dict (see _init_worker), or
+            None if the inputs were already set by _init_worker
+    '''
+    if inputsfile is not None and _worker_inputs.get('inputsfile') != inputsfile:
+        with open(inputsfile, 'rb') as fp:
+            _init_worker(pickle.load(fp))
+        _worker_inputs['inputsfile'] = inputsfile
+
+def _get_inputs(inputsfile=None, inputs=None):
+    '''
+    Returns the inputs dict of a task (see _init_worker): INPUTS if given,
+    for tasks run in threads of the calling process, and otherwise those of
+    this worker process (see _load_worker_inputs)
+    '''
+    if inputs is not None:
+        return inputs
+
+    _load_worker_inputs(inputsfile)
+    return _worker_inputs
+
+def _makeplots_night(night, inputsfile=None, inputs=None):
+    '''
+    Runs surveyqa.nightly.makeplots (or surveyqa.nightly.write_night_data
+    in single page mode) for NIGHT using the inputs of this task (see
+    _get_inputs)
+
+    Returns (night, records): NIGHT, so that the caller knows which night
+    finished, and the stage timing records of this task (if enabled)
+    '''
+    inputs = _get_inputs(inputsfile, inputs)
+    if inputs.get('single_page', False):
+        with stage('nightly.write_night_data', night):
+            surveyqa.nightly.write_night_data(night, inputs['exposures'],
+                inputs['tiles'], inputs['outdir'],
+                night_index=inputs['night_index'],
+                moonloc=inputs['moonlocs'][night],
+                survey_hists=inputs['survey_hists'])
+    else:
+        with stage('nightly.makeplots', night):
+            surveyqa.nightly.makeplots(night, inputs['exposures'],
+                inputs['tiles'], inputs['outdir'],
+                night_index=inputs['night_index'],
+                moonloc=inputs['moonlocs'][night],
+                survey_hists=inputs['survey_hists'],
+                external_data=inputs['external_data'],
+                raster_sky=inputs['raster_sky'])
+    return night, surveyqa.timing.pop_records()
+
+def _summary_components(name, inputsfile=None, inputs=None):
+    '''
+    Returns the (script, div) components of summary figure NAME using the
+    inputs of this task (see _get_inputs), and the stage timing records of
+    this task (if enabled)
+    '''
+    inputs = _get_inputs(inputsfile, inputs)
+    parts = surveyqa.summary.get_summary_components(name,
+        inputs['summary_exposures'], inputs['tiles'],
+        full_progress=inputs['full_progress'],
+        raster_sky=inputs['raster_sky'],
+        tile_stats=inputs['summary_tile_stats'],
+        nightly_stats=inputs['summary_nightly_stats'],
+        single_page=inputs['single_page'],
+        tile_index=inputs['tile_index'])
+    return parts, surveyqa.timing.pop_records()
+
+def _submit(pool, func, *args):
+    '''
+    Submits func(*args) to POOL, a multiprocessing Pool or a
+    concurrent.futures Executor
+
+    Returns a function that waits for and returns the result
+    '''
+    if isinstance(pool, concurrent.futures.Executor):
+        return pool.submit(func, *args).result
+    else:
+        return pool.apply_async(func, args).get
+
+def _run_chunk(func, items):
+    '''
+    Returns [func(x) for x in ITEMS], to run a chunk of tasks in one call
+    '''
+    return [func(x) for x in items]
+
+def _imap_unordered(pool, func, items, chunksize=None):
+    '''
+    Maps FUNC over ITEMS in POOL, a multiprocessing Pool or a
+    concurrent.futures Executor, sending CHUNKSIZE items (default 1) to a
+    worker at a time
+
+    Returns an iterator over the results in the order in which their chunks
+    complete
+    '''
+    chunksize = chunksize or 1
+    if isinstance(pool, concurrent.futures.Executor):
+        items = list(items)
+        futures = [pool.submit(_run_chunk, func, items[i:i+chunksize])
+                   for i in range(0, len(items), chunksize)]
+        return (x for f in concurrent.futures.as_completed(futures) for x in f.result())
+    else:
+        return pool.imap_unordered(func, items, chunksize)
+
+def _link_or_copy(src, dst):
+    '''
+    Hard links SRC to DST, or copies it if the link fails (e.g. because they
+    are on different filesystems)
+    '''
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
 def check_offline_files(dir):
     '''
     Checks if the Bokeh .js and .css files are present (so that the page works offline).
-    If they are not downloaded, they will be fetched and downloaded.
+    If they are not, they are copied (or hard linked) from the static files of
+    the installed bokeh package, and only the files that the package doesn't
+    have are downloaded from the Bokeh CDN.  Bokeh 2 and later have no .css
+    files, which are then skipped.
 
     Args:
         dir : directory of where the offline_files folder should be located.
               If not present, an offline_files folder will be genreated.
+
+    offline_files/bokeh-{version}.stamp is written once all of the files are
+    in place, so that checking an up to date directory is a single stat.
     '''
     path=(PurePath(dir) / "offline_files")
     version = bokeh.__version__
+    stamp = (path / 'bokeh-{version}.stamp'.format(version=version)).as_posix()
+    if os.path.isfile(stamp):
+        return
+
     b_js = (path / 'bokeh-{version}.js'.format(version=version)).as_posix()
     bt_js = (path / 'bokeh_tables-{version}.js'.format(version=version)).as_posix()
     b_css = (path / 'bokeh-{version}.css'.format(version=version)).as_posix()
     bt_css = (path / 'bokeh_tables-{version}.css'.format(version=version)).as_posix()
 
-    if os.path.isfile(b_js) and os.path.isfile(bt_js) and \
-       os.path.isfile(b_css) and os.path.isfile(bt_js):
-        print("Offline Bokeh files found")
-    else:
-        shutil.rmtree(path, True)
-        os.makedirs(path, exist_ok=True)
-
-        url_js = "https://cdn.pydata.org/bokeh/release/bokeh-{version}.min.js".format(version=version)
-        urllib.request.urlretrieve(url_js, b_js)
-
-        url_tables_js = "https://cdn.pydata.org/bokeh/release/bokeh-tables-{version}.min.js".format(version=version)
-        urllib.request.urlretrieve(url_tables_js, bt_js)
+    #- Files of other bokeh versions are no longer referenced by the pages
+    shutil.rmtree(path, True)
+    os.makedirs(path, exist_ok=True)
 
-        url_css = "https://cdn.pydata.org/bokeh/release/bokeh-{version}.min.css".format(version=version)
-        urllib.request.urlretrieve(url_css, b_css)
+    staticdir = bokehjsdir()
+    files = [('js/bokeh.min.js', b_js), ('js/bokeh-tables.min.js', bt_js)]
+    if int(version.split('.')[0]) < 2:
+        files += [('css/bokeh.min.css', b_css), ('css/bokeh-tables.min.css', bt_css)]
 
-        url_tables_css = "https://cdn.pydata.org/bokeh/release/bokeh-tables-{version}.min.css".format(version=version)
-        urllib.request.urlretrieve(url_tables_css, bt_css)
+    for src, dst in files:
+        if os.path.isfile(os.path.join(staticdir, src)):
+            _link_or_copy(os.path.join(staticdir, src), dst)
+            print("Copied offline Bokeh file {} from {}".format(src, staticdir))
+        else:
+            url = "https://cdn.pydata.org/bokeh/release/{}".format(
+                os.path.basename(src).replace('.min', '-{}.min'.format(version)))
+            urllib.request.urlretrieve(url, dst)
+            print("Downloaded offline Bokeh file {}".format(url))
 
-        print("Downloaded offline Bokeh files")
+    with open(stamp, 'w') as fx:
+        fx.write(version+'\n')
 
 def write_night_linkage(outdir, nights, subset):
     '''
@@ -106,12 +300,223 @@ def write_night_linkage(outdir, nights, subset):
 
     print('Wrote {}'.format(outfile))
 
-def makeplots(exposures, tiles, outdir, show_summary = "all", nights = None):
+def get_code_version(tiles):
+    '''
+    Returns a string identifying everything other than the per-night exposure
+    rows that goes into a nightly page: the bokeh version, the surveyqa source
+    code and page templates, and the tiles table.
+
+    Args:
+        tiles: Table of tile locations with columns ...
+    '''
+    h = hashlib.sha1()
+    codedir = os.path.dirname(os.path.abspath(__file__))
+    for dirname, extension in [(codedir, '.py'), (os.path.join(codedir, 'templates'), '.html')]:
+        for filename in sorted(os.listdir(dirname)):
+            if filename.endswith(extension):
+                with open(os.path.join(dirname, filename), 'rb') as fx:
+                    h.update(fx.read())
+
+    h.update(np.ma.getdata(tiles.as_array()).tobytes())
+
+    return 'bokeh-{}-{}'.format(bokeh.__version__, h.hexdigest())
+
+def get_hists_hash(survey_hists):
+    '''
+    Returns a hex digest of the survey-wide histograms from
+    surveyqa.nightly.get_survey_hists
+    '''
+    h = hashlib.sha1()
+    for attribute in sorted(survey_hists):
+        hist, edges = survey_hists[attribute]
+        h.update(attribute.encode())
+        h.update(np.asarray(hist, dtype=float).tobytes())
+        h.update(np.asarray(edges, dtype=float).tobytes())
+
+    return h.hexdigest()
+
+def get_edges_hash(hist_edges):
+    '''
+    Returns a hex digest of the histogram bin edges from
+    surveyqa.nightly.get_hist_edges
+    '''
+    h = hashlib.sha1()
+    for attribute in sorted(hist_edges):
+        h.update(attribute.encode())
+        h.update(np.asarray(hist_edges[attribute], dtype=float).tobytes())
+
+    return h.hexdigest()
+
+def get_night_hashes(exposures, night_index, survey_hists=None, hist_edges=None):
+    '''
+    Computes a content hash of the inputs of each nightly page
+
+    Args:
+        exposures: Table of exposures with column NIGHT
+        night_index: dict of slices into exposures keyed by night, from
+            surveyqa.nightly.get_night_index
+
+    Options:
+        survey_hists: histograms of all exposures overlaid on every nightly
+            page, from surveyqa.nightly.get_survey_hists; if given, they are
+            included in the hash of every night, for pages that embed them.
+            Since they change whenever exposures are added, every page is
+            then regenerated when any night is added.
+        hist_edges: bin edges of the nightly histograms, from
+            surveyqa.nightly.get_hist_edges; if given, they are included in
+            the hash of every night
+
+    Returns dict of hex digest strings keyed by night
+    '''
+    data = exposures.as_array()
+    values = np.ma.getdata(data)
+    mask = np.ma.getmaskarray(data)
+
+    hists = b'' if survey_hists is None else get_hists_hash(survey_hists).encode()
+    edges = b'' if hist_edges is None else get_edges_hash(hist_edges).encode()
+
+    hashes = dict()
+    for night, ii in night_index.items():
+        h = hashlib.sha1(values[ii].tobytes())
+        h.update(mask[ii].tobytes())
+        h.update(hists)
+        h.update(edges)
+        hashes[night] = h.hexdigest()
+
+    return hashes
+
+def read_manifest(outdir):
+    '''
+    Reads outdir/manifest.json written by a previous makeplots run
+
+    Args:
+        outdir: directory containing the manifest
+
+    Returns dict with keys "version" (string) and "nights" (dict of hashes
+    keyed by night); both are empty if there is no previous manifest.  The
+    manifest also has key "hist_edges", the bin edges of the nightly
+    histograms, and that of a run with external_data has key "shared", the
+    hash of the survey-wide histograms written to shared_data.js.
+    '''
+    infile = os.path.join(outdir, 'manifest.json')
+    if not os.path.isfile(infile):
+        return dict(version='', nights=dict())
+
+    with open(infile) as fp:
+        return json.load(fp)
+
+def write_manifest(outdir, manifest):
+    '''
+    Writes outdir/manifest.json, which records the inputs of each nightly page
+
+    Args:
+        outdir: directory to write manifest.json
+        manifest: dict with keys "version" and "nights", see read_manifest
+    '''
+    outfile = os.path.join(outdir, 'manifest.json')
+    with open(outfile, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+
+    print('Wrote {}'.format(outfile))
+
+def get_hourangle(mjd, ra):
+    '''
+    Returns the hour angle in degrees, wrapped into [-180, 180)
+
+    Args:
+        mjd: array of MJD of the exposures
+        ra: array of RA of the exposures in degrees; may be masked
+
+    Returns float array, masked where ra is masked
+    '''
+    D = mjd - 51544.5
+    LST = (168.86072948111115 + 360.98564736628623 * D) % 360
+    return (LST - ra + 180) % 360 - 180
+
+def get_derived_columns(exposures):
+    '''
+    Computes the columns derived from the inputs that aren't already present:
+    HOURANGLE (degrees, in [-180, 180)) from MJD and RA, and the local
+    TIME from MJD (see surveyqa.nightly.get_localtime)
+
+    Args:
+        exposures: Table of exposures with columns MJD, RA
+
+    Returns dict of arrays keyed by column name
+    '''
+    columns = dict()
+    if 'HOURANGLE' not in exposures.colnames:
+        with stage('hourangle'):
+            columns['HOURANGLE'] = get_hourangle(exposures['MJD'], exposures['RA'])
+
+    if 'TIME' not in exposures.colnames:
+        with stage('localtime'):
+            columns['TIME'] = surveyqa.nightly.get_localtime(exposures['MJD'])
+
+    return columns
+
+def add_derived_columns(exposures):
+    '''
+    Returns the exposures with the columns from get_derived_columns added
+
+    Args:
+        exposures: Table of exposures with columns MJD, RA
+
+    Returns astropy Table; this is exposures itself if nothing needs to be
+    added, and otherwise a new table sharing its column data, so that the
+    input table is not modified
+    '''
+    columns = get_derived_columns(exposures)
+    if len(columns) == 0:
+        return exposures
+
+    exposures = Table(exposures, copy=False)
+    for name, data in columns.items():
+        exposures[name] = data
+
+    return exposures
+
+def select_nights(exposures, nights=None, first_night=None, last_night=None):
+    '''
+    Selects the exposures of a subset of nights
+
+    Args:
+        exposures: Table of exposures with column NIGHT
+
+    Options:
+        nights: list of nights (as integers or strings)
+        first_night: first night (YEARMMDD) of a range of nights
+        last_night: last night (YEARMMDD, inclusive) of a range of nights
+
+    Returns boolean array that is True for the exposures in nights and
+    within [first_night, last_night]; unset options don't restrict the
+    selection
+    '''
+    #- Compare in the dtype of the NIGHT column (bytes when read from FITS)
+    #- so that the column doesn't need to be converted
+    night = np.asarray(exposures['NIGHT'])
+    keep = np.ones(len(night), dtype=bool)
+    if nights is not None:
+        nights = np.asarray([str(x) for x in nights], dtype=night.dtype)
+        keep &= np.isin(night, nights)
+    if first_night is not None:
+        keep &= (night >= np.asarray(str(first_night), dtype=night.dtype))
+    if last_night is not None:
+        keep &= (night <= np.asarray(str(last_night), dtype=night.dtype))
+
+    return keep
+
+def makeplots(exposures, tiles, outdir, show_summary = "all", nights = None, incremental = False, external_data = False,
+              jobs = None, chunksize = None, pool = None, timing_report = None, first_night = None, last_night = None,
+              single_page = False, full_progress = False, raster_sky = False,
+              tile_stats = None, nightly_stats = None):
     '''
     Generates summary plots for the DESI survey QA
 
     Args:
-        exposures: Table of exposures with columns ...
+        exposures: Table of exposures with columns ...; columns HOURANGLE
+            and TIME are computed if not present (see add_derived_columns),
+            e.g. unless they were cached with the inputs by surveyqa.cache
         tiles: Table of tile locations with columns ...
         outdir: directory to write the files
         show_summary:
@@ -120,47 +525,249 @@ def makeplots(exposures, tiles, outdir, show_summary = "all", nights = None):
             if = "all": make summary page on all nights
             else: raises a ValueError
         nights: list of nights (as integers or strings)
+        first_night, last_night: only make the pages of nights within this
+            range (inclusive, as YEARMMDD), e.g. to re-render the last week;
+            can be combined with nights (see select_nights)
+        incremental: if True, only regenerate the night-*.html pages whose
+            inputs changed since the previous run, as recorded in
+            outdir/manifest.json.  The inputs of a night are its exposures
+            and the bin edges of its histograms.  The survey-wide histograms
+            change whenever a night is added, so this implies external_data
+            (unless single_page), so that only shared_data.js (or
+            dashboard.html) needs to be rewritten instead of every page.
+            The bin edges of the histograms are kept from the previous run
+            unless the survey outgrows them, in which case all pages are
+            regenerated (see surveyqa.nightly.get_hist_edges).
+        external_data: if True, write the tile footprint and survey-wide
+            histograms once to outdir/shared_data.js and have the nightly
+            pages load them from there instead of embedding a copy each
+        jobs: number of worker processes (default: number of CPUs); ignored if
+            pool is given
+        chunksize: number of nights sent to a worker at a time, for pools
+            and executors alike (default 1)
+        pool: an existing multiprocessing Pool or ThreadPool, or a
+            concurrent.futures ProcessPoolExecutor or ThreadPoolExecutor, to
+            run the tasks in instead of creating a new pool; it is left open
+            so that it can be reused across calls
+        timing_report: if not None, record the wall time and memory use of
+            each stage (see surveyqa.timing), write them to this JSON file and
+            print a summary at the end of the run
+        single_page: if True, write a single page dashboard (dashboard.html)
+            that loads the data of the night being viewed from a small
+            per-night bundle (nights/night-*.js), instead of a full page per
+            night; external_data is not needed in this mode
+        full_progress: if True, plot the survey progress of every finished
+            tile instead of the start and end of each night (see
+            surveyqa.summary.get_progress)
+        raster_sky: if True, show the tiles of the sky maps as images binned
+            server-side instead of a point per tile, keeping points only for
+            the tiles of the night shown (see surveyqa.skyimage)
+        tile_stats, nightly_stats: per-tile and per-night aggregates of all
+            exposures, in the order of the exposures table, e.g. as kept up
+            to date by surveyqa.cache.append_exposures; used for the summary
+            page with show_summary="all" instead of regrouping all exposures
 
-    Writes outdir/summary.html and outdir/night-*.html
+    Writes outdir/summary.html, outdir/night-*.html (or outdir/dashboard.html
+    and outdir/nights/night-*.js) and outdir/manifest.json
     '''
+    #- Timing is only turned on for this run, leaving the setting of the
+    #- calling process as it was
+    with surveyqa.timing.recording(timing_report is not None):
+        _makeplots(exposures, tiles, outdir, show_summary=show_summary, nights=nights,
+            incremental=incremental, external_data=external_data, jobs=jobs,
+            chunksize=chunksize, pool=pool, timing_report=timing_report,
+            first_night=first_night, last_night=last_night, single_page=single_page,
+            full_progress=full_progress, raster_sky=raster_sky,
+            tile_stats=tile_stats, nightly_stats=nightly_stats)
 
-    check_offline_files(outdir)
+def _makeplots(exposures, tiles, outdir, show_summary, nights, incremental, external_data,
+               jobs, chunksize, pool, timing_report, first_night, last_night,
+               single_page, full_progress, raster_sky, tile_stats, nightly_stats):
+    '''
+    Runs makeplots, with timing already turned on if timing_report is given
+    '''
+    start = time.time()
 
-    D = exposures["MJD"] - 51544.5
-    LST = (168.86072948111115 + 360.98564736628623 * D) % 360
-    exposures["HOURANGLE"] = LST - exposures["RA"]
+    #- Pages that embed the survey histograms would all need to be rewritten
+    #- whenever a night is added, so incremental runs load them from
+    #- shared_data.js instead
+    if incremental and not (external_data or single_page):
+        print('Incremental run: writing the survey histograms to shared_data.js (external_data)')
+        external_data = True
 
-    def change_range(i):
-        if i > 180:
-            return i - 360
-        if i < -180:
-            return 360 + i
-        return i
+    check_offline_files(outdir)
 
-    exposures["HOURANGLE"] = [change_range(i) for i in exposures["HOURANGLE"]]
+    exposures = add_derived_columns(exposures)
 
-    exposures_sub = exposures
-    if nights is not None:
-        nights = [str(i) for i in nights]
-        exposures_sub = exposures[[x in nights for x in exposures['NIGHT']]]
+    subset = (nights is not None or first_night is not None or last_night is not None)
+    if subset:
+        exposures_sub = exposures[select_nights(exposures, nights, first_night, last_night)]
+    else:
+        exposures_sub = exposures
 
     exptiles = np.unique(exposures['TILEID'])
     print('Generating QA for {} exposures on {} tiles'.format(
         len(exposures), len(exptiles)))
 
+    #- Sort by night so that each night is a contiguous slice for the workers
+    exposures_sub = exposures_sub[np.argsort(exposures_sub['NIGHT'], kind='stable')]
+    night_index = surveyqa.nightly.get_night_index(exposures_sub)
+
     if show_summary=="subset":
-        surveyqa.summary.makeplots(exposures_sub, tiles, outdir)
+        summary_exposures = exposures_sub
     elif show_summary=="all":
-        surveyqa.summary.makeplots(exposures, tiles, outdir)
-    elif show_summary!="no":
+        summary_exposures = exposures
+    elif show_summary=="no":
+        summary_exposures = None
+    else:
         raise ValueError('show_summary should be "all", "subset", or "no". The value of show_summary was: {}'.format(show_summary))
 
-    nights_sub = sorted(set(exposures_sub['NIGHT']))
-    write_night_linkage(outdir, nights_sub, nights != None)
+    #- Per-tile aggregates shared by the summary figures, and per-night
+    #- aggregates of the summary table if they were given
+    summary_tile_stats = None
+    summary_nightly_stats = None
+    if summary_exposures is exposures:
+        summary_tile_stats = tile_stats
+        summary_nightly_stats = nightly_stats
+    if summary_exposures is not None and summary_tile_stats is None:
+        with stage('get_tile_stats'):
+            summary_tile_stats = surveyqa.summary.get_tile_stats(summary_exposures)
+    tile_index = surveyqa.summary.get_tile_index(tiles)
+
+    nights_sub = sorted(night_index)
+    if not single_page:
+        write_night_linkage(outdir, nights_sub, subset)
+
+    if single_page:
+        nightfile = os.path.join(outdir, 'nights', 'night-{}.js')
+    else:
+        nightfile = os.path.join(outdir, 'night-{}.html')
+
+    #- Only nights whose inputs differ from the previous manifest need updating
+    manifest = read_manifest(outdir)
+    version = get_code_version(tiles)
+    if single_page:
+        version += '-single-page'
+    elif external_data:
+        version += '-external'
+    if raster_sky and not single_page:
+        version += '-raster'
+    if manifest['version'] != version:
+        manifest = dict(version=version, nights=dict())
+
+    #- Survey-wide histograms overlaid on every nightly page; they change as
+    #- the survey grows, so they are inputs of the nights only if the pages
+    #- embed them rather than load them from shared_data.js or the dashboard.
+    #- Their bin edges, which the nightly histograms share, are kept from
+    #- the previous run as long as they cover the survey.
+    with stage('get_survey_hists'):
+        hist_edges = surveyqa.nightly.get_hist_edges(exposures,
+            previous=manifest.get('hist_edges') if incremental else None)
+        survey_hists = surveyqa.nightly.get_survey_hists(exposures, edges=hist_edges)
+    embedded_hists = not (external_data or single_page)
+    manifest['hist_edges'] = {attribute: edges.tolist() for attribute, edges in hist_edges.items()}
+
+    with stage('get_night_hashes'):
+        hashes = get_night_hashes(exposures_sub, night_index,
+            survey_hists if embedded_hists else None, hist_edges=hist_edges)
+    if incremental:
+        nights_todo = [night for night in nights_sub
+            if manifest['nights'].get(night) != hashes[night] or
+               not os.path.isfile(nightfile.format(night))]
+        print('Regenerating {} of {} nights'.format(len(nights_todo), len(nights_sub)))
+    else:
+        nights_todo = nights_sub
+
+    #- Moon locations for all nights in one call, cached across runs
+    with stage('get_moonlocs'):
+        moonlocs = surveyqa.nightly.get_moonlocs(sorted(set(nights_todo) | set(nights_sub[-1:])),
+            cachefile=os.path.join(outdir, 'moonlocs.json'))
+
+    #- The tiles and raster_sky are part of the version, so shared_data.js
+    #- only needs to be rewritten when the survey histograms change
+    if external_data and not single_page:
+        shared_hash = get_hists_hash(survey_hists)
+        if (not incremental or manifest.get('shared') != shared_hash or
+                not os.path.isfile(os.path.join(outdir, 'shared_data.js'))):
+            with stage('write_shared_data'):
+                surveyqa.nightly.write_shared_data(outdir, tiles, survey_hists, raster_sky=raster_sky)
+        manifest['shared'] = shared_hash
+
+    inputs = dict(exposures=exposures_sub, tiles=tiles, outdir=outdir,
+                  night_index=night_index, moonlocs=moonlocs,
+                  survey_hists=survey_hists, external_data=external_data,
+                  summary_exposures=summary_exposures,
+                  summary_tile_stats=summary_tile_stats,
+                  summary_nightly_stats=summary_nightly_stats,
+                  tile_index=tile_index,
+                  single_page=single_page, full_progress=full_progress,
+                  raster_sky=raster_sky, timing=surveyqa.timing.enabled)
+
+    #- Hand the inputs to the workers: through the initializer of a new
+    #- pool, directly for threads of this process, or through a temporary
+    #- file loaded once per worker process of a pool passed in by the caller
+    inputsfile = None
+    thread_inputs = None
+    if pool is None:
+        if jobs is None:
+            jobs = mp.cpu_count()
+        workers = mp.Pool(jobs, initializer=_init_worker, initargs=(inputs,))
+    elif isinstance(pool, (mp.pool.ThreadPool, concurrent.futures.ThreadPoolExecutor)):
+        thread_inputs = inputs
+        workers = pool
+    else:
+        fd, inputsfile = tempfile.mkstemp(prefix='surveyqa-inputs-', suffix='.pickle')
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(inputs, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        workers = pool
+
+    try:
+        #- Queue the summary figures first so that they are built alongside the
+        #- nightly pages, then assemble the summary page from their components
+        summary_parts = dict()
+        if summary_exposures is not None:
+            for name in surveyqa.summary.summary_figures:
+                summary_parts[name] = _submit(workers, _summary_components, name, inputsfile, thread_inputs)
+
+        #- Start the nights with the most exposures first so that the longest
+        #- tasks don't end up running alone at the end
+        nights_todo = sorted(nights_todo, reverse=True,
+            key=lambda night: night_index[night].stop - night_index[night].start)
+        func = functools.partial(_makeplots_night, inputsfile=inputsfile, inputs=thread_inputs)
+        for i, (night, records) in enumerate(_imap_unordered(workers, func, nights_todo, chunksize)):
+            surveyqa.timing.add_records(records)
+            print('Finished night {} ({}/{})'.format(night, i+1, len(nights_todo)))
+
+        #- The dashboard links to every night with a data bundle, including
+        #- those from previous runs, and opens on the last of them; its
+        #- figures are made for the last night of this run, whose data are
+        #- at hand, and the page loads the bundle of the night to show
+        if single_page and len(nights_sub) > 0:
+            nights_all = sorted([f[6:14] for f in os.listdir(os.path.join(outdir, 'nights'))
+                                 if re.match('night-[0-9]+.js$', f)])
+            with stage('write_dashboard'):
+                surveyqa.nightly.write_dashboard(nights_sub[-1], nights_all,
+                    exposures_sub, tiles, outdir, night_index=night_index,
+                    moonloc=moonlocs[nights_sub[-1]], survey_hists=survey_hists,
+                    raster_sky=raster_sky)
 
-    pool = mp.Pool(mp.cpu_count())
+        if summary_exposures is not None:
+            for name, result in summary_parts.items():
+                summary_parts[name], records = result()
+                surveyqa.timing.add_records(records)
+            surveyqa.summary.write_summary_html(outdir, max(summary_exposures['NIGHT']), summary_parts)
+    finally:
+        if pool is None:
+            workers.close()
+            workers.join()
+        if inputsfile is not None:
+            os.remove(inputsfile)
 
-    pool.starmap(surveyqa.nightly.makeplots, [(night, exposures_sub, tiles, outdir) for night in sorted(set(exposures_sub['NIGHT']))])
+    manifest['nights'].update(hashes)
+    write_manifest(outdir, manifest)
 
-    pool.close()
-    pool.join()
+    if timing_report is not None:
+        records = surveyqa.timing.pop_records()
+        surveyqa.timing.write_report(timing_report, records, wall=time.time()-start)
+        print(surveyqa.timing.format_summary(surveyqa.timing.summarize(records)))
+        print('Total wall time {:.1f} seconds'.format(time.time()-start))
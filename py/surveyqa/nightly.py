@@ -4,10 +4,10 @@ Plots for daily DESI observing
 
 from __future__ import absolute_import, division, print_function
 import sys, os
+import contextlib
 import numpy as np
 import bokeh as bk
 
-import jinja2
 from bokeh.embed import components
 import bokeh
 import bokeh.plotting as bk
@@ -22,13 +22,20 @@ import astropy.units as u
 from datetime import tzinfo
 from datetime import datetime
 from bokeh.models.glyphs import HBar
-from bokeh.models import LabelSet, FactorRange
+from bokeh.models import LabelSet, FactorRange, Range1d, Title
 from bokeh.palettes import viridis
 from bokeh.transform import factor_cmap
 from bokeh.models.widgets.tables import DataTable, TableColumn
 from astropy import coordinates
+from astropy.utils import iers
 from bokeh.models.widgets import NumberFormatter
 from pathlib import PurePath
+import json
+
+from surveyqa.timing import stage
+import surveyqa.render
+import surveyqa.skyimage
+from surveyqa.offline import offline_iers
 
 #- Avoid warnings from date & coord calculations in the future
 import warnings
@@ -36,25 +43,63 @@ warnings.filterwarnings('ignore', 'ERFA function.*dubious year.*')
 warnings.filterwarnings('ignore', 'Tried to get polar motions for times after IERS data is valid.*')
 
 utc_offset = -7*u.hour
-def find_night(exposures, night):
+def get_localtime(mjd):
+    """
+    Converts UTC MJDs into Arizona local times with a single vectorized Time
+
+    ARGS:
+        mjd : array of MJD values
+
+    Returns numpy datetime64 array
+    """
+    with offline_iers():
+        return (Time(np.asarray(mjd), format='mjd', scale='utc') + utc_offset).datetime64
+
+def get_night_index(exposures):
+    """
+    Generates an index of the contiguous block of rows of each night
+
+    ARGS:
+        exposures : Table of exposures with column NIGHT, sorted by NIGHT
+
+    Returns dict of slice objects keyed by night (string), such that
+    exposures[index[night]] are the exposures of that night
+    """
+    nights = np.asarray(exposures['NIGHT']).astype(str)
+    if np.any(nights[1:] < nights[:-1]):
+        raise ValueError('exposures must be sorted by NIGHT')
+
+    unique, start, counts = np.unique(nights, return_index=True, return_counts=True)
+    index = dict()
+    for night, i, n in zip(unique, start, counts):
+        index[night] = slice(i, i+n)
+
+    return index
+
+def find_night(exposures, night, night_index=None):
     """
     Generates a subtable of exposures corresponding to data from a single night N and adds column TIME
+    if it isn't already present (see get_localtime)
 
     ARGS:
         exposures : Table of exposures with columns...
         night : String representing a single value in the NIGHT column of the EXPOSURES table
 
+    Options:
+        night_index : dict of slices from get_night_index(exposures); if given,
+            the night is selected by slicing instead of comparing every row
+
     Returns an astropy table object
     """
     #- Filters by NIGHT
-    exposures = exposures[exposures['NIGHT'] == night]
+    if night_index is not None:
+        exposures = exposures[night_index[night]]
+    else:
+        exposures = exposures[exposures['NIGHT'] == night]
 
-    #- Creates DateTime objects in Arizona timezone
-    mjds = np.array(exposures['MJD'])
-    times = [(Time(mjd, format='mjd', scale='utc') + utc_offset).to_datetime() for mjd in mjds]
-
-    #- Adds times to table
-    exposures['TIME'] = times
+    #- Adds times in Arizona timezone, unless precomputed for the full table
+    if 'TIME' not in exposures.colnames:
+        exposures['TIME'] = get_localtime(exposures['MJD'])
 
     return exposures
 
@@ -126,17 +171,12 @@ def plot_timeseries(source, name, color, tools=None, x_range=None, title=None, t
 
     return fig
 
-def get_nightlytable(exposures):
+def get_nightlytable_data(exposures):
     '''
-    Generates a summary table of the exposures from the night observed.
-
-    Args:
-        exposures: Table of exposures with columns...
-
-    Returns a bokeh DataTable object.
+    Returns the columns of the nightly table (see get_nightlytable) as a dict
+    of numpy arrays
     '''
-
-    source = ColumnDataSource(data=dict(
+    return dict(
         expid = np.array(exposures['EXPID']),
         flavor = np.array(exposures['FLAVOR'], dtype='str'),
         program = np.array(exposures['PROGRAM'], dtype='str'),
@@ -147,7 +187,19 @@ def get_nightlytable(exposures):
         transp = np.array(exposures['TRANSP']),
         sky = np.array(exposures['SKY']),
         hourangle = np.array(exposures['HOURANGLE']),
-    ))
+    )
+
+def get_nightlytable(exposures):
+    '''
+    Generates a summary table of the exposures from the night observed.
+
+    Args:
+        exposures: Table of exposures with columns...
+
+    Returns a bokeh DataTable object.
+    '''
+
+    source = ColumnDataSource(data=get_nightlytable_data(exposures), name='night_table')
 
     formatter = NumberFormatter(format='0,0.00')
     columns = [
@@ -168,6 +220,49 @@ def get_nightlytable(exposures):
     return nightly_table
 
 
+#- Kitt Peak National Observatory, from the astropy site registry, so that
+#- EarthLocation.of_site doesn't need to download the registry
+kitt = coordinates.EarthLocation.from_geodetic(lon=-111.6*u.deg, lat=31.963333*u.deg, height=2120*u.m)
+
+def get_midnight(nights):
+    """
+    Returns local (Arizona) midnight for the given NIGHTS
+
+    Args:
+        nights : list of nights = YEARMMDD of sunset
+
+    Returns a Time object with one entry per night
+    """
+    #- Re-formats nights into YYYY-MM-DD HH:MM:SS
+    iso_format = [n[:4] + '-' + n[4:6] + '-' + n[6:] + ' 00:00:00' for n in nights]
+    with offline_iers():
+        t_midnight = Time(iso_format, format='iso') + 24*u.hour
+        #- Sets timezone
+        t_local = t_midnight + (-7)*u.hour
+
+    return t_local
+
+def get_moon(times):
+    """
+    Computes the location of the moon seen from Kitt Peak offline
+
+    Args:
+        times : Time object
+
+    Returns a SkyCoord object
+
+    Only the IERS tables bundled with astropy are used (see
+    surveyqa.offline.offline_iers); for times past their end UT1-UTC is
+    taken as zero, which is far below the accuracy needed to plot the moon.
+    Astropy versions without the iers_degraded_accuracy setting only warn
+    about this (see the warnings filters above).
+    """
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(offline_iers())
+        if hasattr(iers.conf, 'iers_degraded_accuracy'):
+            stack.enter_context(iers.conf.set_temp('iers_degraded_accuracy', 'ignore'))
+        return coordinates.get_body('moon', times, location=kitt)
+
 def get_moonloc(night):
     """
     Returns the location of the moon on the given NIGHT
@@ -177,56 +272,132 @@ def get_moonloc(night):
 
     Returns a SkyCoord object
     """
-    #- Re-formats night into YYYY-MM-DD HH:MM:SS
-    iso_format = night[:4] + '-' + night[4:6] + '-' + night[6:] + ' 00:00:00'
-    t_midnight = Time(iso_format, format='iso') + 24*u.hour
-    #- Sets timezone
-    t_local = t_midnight + (-7)*u.hour
-
-    #- Sets location
-    kitt = coordinates.EarthLocation.of_site('Kitt Peak National Observatory')
-
     #- Gets moon coordinates
-    moon_loc = coordinates.get_moon(time=t_local, location=kitt)
+    moon_loc = get_moon(get_midnight([night])[0])
 
     return moon_loc
 
+def get_moonlocs(nights, cachefile=None):
+    """
+    Returns the locations of the moon on the given NIGHTS, computed with
+    a single vectorized ephemeris call
 
-def get_skypathplot(exposures, tiles, width=600, height=300, min_border_left=50, min_border_right=50):
+    Args:
+        nights : list of nights = YEARMMDD of sunset
+
+    Options:
+        cachefile : JSON file of moon locations from previous calls; nights
+            found there are not recomputed, and new nights are added to it
+
+    Returns dict of (ra, dec) tuples in degrees keyed by night
     """
-    Generate a plot which maps the location of tiles observed on NIGHT
+    moonlocs = dict()
+    if cachefile is not None and os.path.isfile(cachefile):
+        with open(cachefile) as fp:
+            moonlocs = {night: tuple(radec) for night, radec in json.load(fp).items()}
+
+    todo = sorted(set(nights) - set(moonlocs))
+    if len(todo) > 0:
+        moon_loc = get_moon(get_midnight(todo))
+        for night, ra, dec in zip(todo, moon_loc.ra.deg, moon_loc.dec.deg):
+            moonlocs[night] = (float(ra), float(dec))
+
+        if cachefile is not None:
+            with open(cachefile, 'w') as fp:
+                json.dump(moonlocs, fp, indent=1, sort_keys=True)
+
+    return {night: moonlocs[night] for night in nights}
+
+
+def get_skypath_data(exposures, tiles, moonloc=None):
+    """
+    Computes the per-night data of the sky path plot (see get_skypathplot)
 
     ARGS:
         exposures : Table of exposures with columns specific to a single night
         tiles: Table of tile locations with columns ...
 
     Options:
-        height, width: height and width of the graph in pixels
-        min_border_left, min_border_right: set minimum width of surrounding labels (in pixels)
+        moonloc: (ra, dec) of the moon on NIGHT in degrees, e.g. from
+            get_moonlocs; computed if not given
 
-    Returns a bokeh figure object
+    Returns dict of ColumnDataSource data keyed by source name:
+    night_skypath (observed tiles in time order), night_skypath_first (the
+    first observed tile) and night_moon (the moon at midnight)
     """
     #- Merges tiles data for all exposures on a single night N
     tiles_and_exps = join(exposures, tiles['STAR_DENSITY', 'EXPOSEFAC', 'OBSCONDITIONS', 'TILEID'], keys='TILEID')
     tiles_and_exps.sort('TIME')
 
-    #- Converts data format into ColumnDataSource
-    src = ColumnDataSource(data={'RA':np.array(tiles_and_exps['RA']),
-                                 'DEC':np.array(tiles_and_exps['DEC']),
-                                 'EXPID':np.array(tiles_and_exps['EXPID']),
-                                 'PROGRAM':np.array([str(n) for n in tiles_and_exps['PROGRAM']])})
+    if moonloc is None:
+        night = exposures['NIGHT'][0]
+        moonloc = get_moonlocs([night])[night]
+    ra, dec = moonloc
 
-    #- Plot options
-    night_name = exposures['NIGHT'][0]
-    string_date = night_name[4:6] + "-" + night_name[6:] + "-" + night_name[:4]
+    first = tiles_and_exps[0]
+    data = dict()
+    data['night_skypath'] = {'RA':np.array(tiles_and_exps['RA']),
+                             'DEC':np.array(tiles_and_exps['DEC']),
+                             'EXPID':np.array(tiles_and_exps['EXPID']),
+                             'PROGRAM':np.array([str(n) for n in tiles_and_exps['PROGRAM']])}
+    data['night_skypath_first'] = {'RA':[first['RA']], 'DEC':[first['DEC']]}
+    data['night_moon'] = {'RA':[ra], 'DEC':[dec]}
+
+    return data
+
+def get_skypath_title(night):
+    """
+    Returns the title of the sky path plot of NIGHT (YEARMMDD)
+    """
+    return 'Tiles observed on ' + night[4:6] + "-" + night[6:] + "-" + night[:4]
+
+def get_skypathplot(exposures, tiles, width=600, height=300, min_border_left=50, min_border_right=50, moonloc=None, external_data=False, rasterize=False):
+    """
+    Generate a plot which maps the location of tiles observed on NIGHT
+
+    ARGS:
+        exposures : Table of exposures with columns specific to a single night
+        tiles: Table of tile locations with columns ...
+
+    Options:
+        height, width: height and width of the graph in pixels
+        min_border_left, min_border_right: set minimum width of surrounding labels (in pixels)
+        moonloc: (ra, dec) of the moon on NIGHT in degrees, e.g. from
+            get_moonlocs; computed if not given
+        external_data: if True, the tile footprint is left empty to be
+            filled from shared_data.js (see write_shared_data)
+        rasterize: if True, show the tile footprint as an image binned
+            server-side (see surveyqa.skyimage) instead of a point per tile
 
-    fig = bk.figure(width=width, height=height, title='Tiles observed on ' + string_date,
+    The per-night sources (see get_skypath_data) and the title are named
+    models, so that their values can be swapped for another night.
+
+    Returns a bokeh figure object
+    """
+    data = get_skypath_data(exposures, tiles, moonloc)
+    src = ColumnDataSource(data=data['night_skypath'], name='night_skypath')
+
+    #- Plot options
+    title = Title(text=get_skypath_title(exposures['NIGHT'][0]), name='night_skypath_title')
+    fig = bk.figure(width=width, height=height, title=title,
                     min_border_left=min_border_left, min_border_right=min_border_right)
     fig.yaxis.axis_label = 'Declination (degrees)'
     fig.xaxis.axis_label = 'Right Ascension (degrees)'
 
     #- Plots all tiles
-    unobs = fig.circle(tiles['RA'], tiles['DEC'], color='gray', size=1)
+    if rasterize:
+        grid = surveyqa.skyimage.get_sky_grid(tiles)
+        if external_data:
+            footprint = None
+        else:
+            footprint = surveyqa.skyimage.get_footprint_image(tiles['RA'], tiles['DEC'], grid)
+        surveyqa.skyimage.plot_sky_image(fig, footprint, grid,
+            surveyqa.skyimage.get_footprint_mapper(), name='shared_footprint')
+    elif external_data:
+        footprint = ColumnDataSource(data=dict(RA=[], DEC=[]), name='shared_footprint')
+        fig.circle('RA', 'DEC', source=footprint, color='gray', size=1)
+    else:
+        fig.circle(tiles['RA'], tiles['DEC'], color='gray', size=1)
 
     #- Color-coding for program
     EXPTYPES = ['DARK', 'GRAY', 'BRIGHT']
@@ -235,22 +406,18 @@ def get_skypathplot(exposures, tiles, width=600, height=300, min_border_left=50,
 
     #- Plots tiles observed on NIGHT
     obs = fig.scatter('RA', 'DEC', size=5, fill_alpha=0.7, legend='PROGRAM', source=src, color=mapper)
-    fig.line(src.data['RA'], src.data['DEC'], color='navy', alpha=0.4)
+    fig.line('RA', 'DEC', source=src, color='navy', alpha=0.4)
 
     #- Stars the first point observed on NIGHT
-    first = tiles_and_exps[0]
-    fig.asterisk(first['RA'], first['DEC'], size=10, line_width=1.5, fill_color=None, color='orange')
+    first = ColumnDataSource(data=data['night_skypath_first'], name='night_skypath_first')
+    fig.asterisk('RA', 'DEC', source=first, size=10, line_width=1.5, fill_color=None, color='orange')
 
     #- Adds moon location at midnight on NIGHT
-    night = exposures['NIGHT'][0]
-    moon_loc = get_moonloc(night)
-    ra, dec = float(moon_loc.ra.to_string(decimal=True)), float(moon_loc.dec.to_string(decimal=True))
-    fig.circle(ra, dec, size=10, color='gold')
-
+    moon = ColumnDataSource(data=data['night_moon'], name='night_moon')
+    fig.circle('RA', 'DEC', source=moon, size=10, color='gold')
 
     #- Circles the first point observed on NIGHT
-    first = tiles_and_exps[0]
-    fig.asterisk(first['RA'], first['DEC'], size=10, line_width=1.5, fill_color=None, color='gold')
+    fig.asterisk('RA', 'DEC', source=first, size=10, line_width=1.5, fill_color=None, color='gold')
 
     #- Adds hover tool
     TOOLTIPS = [("(RA, DEC)", "(@RA, @DEC)"), ("EXPID", "@EXPID")]
@@ -260,30 +427,134 @@ def get_skypathplot(exposures, tiles, width=600, height=300, min_border_left=50,
     return fig
 
 
-def overlaid_hist(all_exposures, night_exposures, attribute, color, width=300, height=150, min_border_left=50, min_border_right=50):
+#- Attributes histogrammed on the nightly pages, and their number of bins
+hist_attributes = ('AIRMASS', 'SEEING', 'EXPTIME', 'TRANSP', 'HOURANGLE', 'SKY')
+hist_nbins = 50
+
+def get_hist_edges(exposures, attributes=hist_attributes, nbins=hist_nbins, pad=0.05, previous=None):
+    """
+    Computes the bin edges of the histograms of the nightly pages from the
+    range of the science exposures of the survey, so that every night is
+    binned the same way as the survey it is compared to
+
+    ARGS:
+        exposures : a table of exposures, including calibration exposures
+
+    Options:
+        attributes : names of columns in the exposures table to histogram
+        nbins : number of bins
+        pad : fraction of the range of the values added on each side
+        previous : dict of edges, e.g. from a previous run; they are kept
+            for the attributes whose values they still cover, so that the
+            bins only move when the survey outgrows them
+
+    Returns dict of arrays of nbins+1 edges keyed by attribute
+    """
+    keep = (exposures['PROGRAM'] != 'CALIB')
+    edges = dict()
+    for attribute in attributes:
+        values = exposures[attribute][keep]
+        values = np.ma.getdata(values)[~np.ma.getmaskarray(values)].astype(float)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            lo, hi = 0.0, 1.0
+        else:
+            lo, hi = np.min(values), np.max(values)
+
+        if previous is not None and attribute in previous:
+            old = np.asarray(previous[attribute], dtype=float)
+            if old[0] <= lo and hi <= old[-1]:
+                edges[attribute] = old
+                continue
+
+        if hi > lo:
+            lo, hi = lo - pad*(hi-lo), hi + pad*(hi-lo)
+        else:
+            lo, hi = lo - 0.5, hi + 0.5
+        edges[attribute] = np.linspace(lo, hi, nbins+1)
+
+    return edges
+
+def get_attribute_hist(values, edges):
+    """
+    Histograms values of an attribute
+
+    ARGS:
+        values : array or (masked) column of values
+        edges : array of bin edges, e.g. from get_hist_edges
+
+    Masked and NaN values and values outside of the edges are not counted.
+
+    Returns (hist, edges) like np.histogram(..., density=True)
+    """
+    values = np.ma.getdata(values)[~np.ma.getmaskarray(values)].astype(float)
+    return np.histogram(values[np.isfinite(values)], density=True, bins=edges)
+
+def get_survey_hists(exposures, attributes=hist_attributes, edges=None):
+    """
+    Computes the histograms of all science exposures that are overlaid on
+    every nightly page, so that they can be computed once per survey
+
+    ARGS:
+        exposures : a table of exposures, including calibration exposures
+
+    Options:
+        attributes : names of columns in the exposures table to histogram
+        edges : dict of bin edges keyed by attribute from get_hist_edges;
+            computed from exposures if not given
+
+    Returns dict of (hist, edges) tuples from get_attribute_hist keyed by
+    attribute; the nightly histograms use the same edges
+    """
+    if edges is None:
+        edges = get_hist_edges(exposures, attributes)
+
+    keep = (exposures['PROGRAM'] != 'CALIB')
+    hists = dict()
+    for attribute in attributes:
+        hists[attribute] = get_attribute_hist(exposures[attribute][keep], edges[attribute])
+
+    return hists
+
+def overlaid_hist(all_exposures, night_exposures, attribute, color, width=300, height=150, min_border_left=50, min_border_right=50, all_hist=None, external_data=False):
     """
     Generates an overlaid histogram for a single attribute comparing the distribution
     for all of the exposures vs. those from just one night
 
     ARGS:
-        all_exposures : a table of all the science exposures
+        all_exposures : a table of all the science exposures; may be None if all_hist is given
         night_exposures : a table of all the science exposures for a single night
         attribute : a string name of a column in the exposures tables
         color : color of histogram
     Options:
         height, width: height and width of the graph in pixels
         min_border_left, min_border_right: set minimum width of surrounding labels (in pixels)
+        all_hist: precomputed (hist, edges) of all_exposures, e.g. from
+            get_survey_hists; computed from all_exposures if not given
+        external_data: if True, the histogram of all exposures is left empty
+            to be filled from shared_data.js (see write_shared_data)
+
+    Both histograms use the bin edges of all_hist (see get_hist_edges); the
+    histogram of night_exposures is the named
+    source night_hist_ATTRIBUTE so that it can be swapped for another night.
 
     Returns a bokeh figure object
     """
-    hist_all, edges_all = np.histogram(np.array(all_exposures[attribute]), density=True, bins=50)
-    hist_night, edges_night = np.histogram(np.array(night_exposures[attribute]), density=True, bins=50)
+    if all_hist is None:
+        all_hist = get_survey_hists(all_exposures, attributes=[attribute])[attribute]
+    hist_all, edges_all = all_hist
+    hist_night, edges_night = get_attribute_hist(night_exposures[attribute], edges_all)
 
     fig = bk.figure(plot_width=width, plot_height=height,
                     x_axis_label = attribute.title(), y_axis_label = 'title',
                     min_border_left=min_border_left, min_border_right=min_border_right)
-    fig.quad(top=hist_all, bottom=0, left=edges_all[:-1], right=edges_all[1:], fill_color=color, alpha=0.2)
-    fig.quad(top=hist_night, bottom=0, left=edges_night[:-1], right=edges_night[1:], fill_color=color, alpha=0.6)
+    if external_data:
+        source_all = ColumnDataSource(data=dict(top=[], left=[], right=[]), name='shared_hist_'+attribute)
+        fig.quad(top='top', bottom=0, left='left', right='right', source=source_all, fill_color=color, alpha=0.2)
+    else:
+        fig.quad(top=hist_all, bottom=0, left=edges_all[:-1], right=edges_all[1:], fill_color=color, alpha=0.2)
+    source_night = ColumnDataSource(data=dict(top=hist_night, left=edges_night[:-1], right=edges_night[1:]), name='night_hist_'+attribute)
+    fig.quad(top='top', bottom=0, left='left', right='right', source=source_night, fill_color=color, alpha=0.6)
 
     if attribute == 'TRANSP':
         fig.xaxis.axis_label = 'Transparency'
@@ -302,32 +573,75 @@ def overlaid_hist(all_exposures, night_exposures, attribute, color, width=300, h
 
     return fig
 
-def makeplots(night, exposures, tiles, outdir):
+def write_shared_data(outdir, tiles, survey_hists, raster_sky=False):
+    """
+    Writes the data shared by all nightly pages, so that pages made with
+    external_data=True load it by reference instead of each embedding a copy
+
+    ARGS:
+        outdir : directory to write shared_data.js
+        tiles : Table of tile locations with columns RA, DEC
+        survey_hists : histograms of all exposures, from get_survey_hists
+
+    Options:
+        raster_sky : if True, write the tile footprint as an image for the
+            pages made with raster_sky=True (see get_skypathplot)
+
+    Writes outdir/shared_data.js, which calls the javascript function
+    `load_shared_data` with the data of each named ColumnDataSource
+    """
+    sources = dict()
+    if raster_sky:
+        grid = surveyqa.skyimage.get_sky_grid(tiles)
+        footprint = surveyqa.skyimage.get_footprint_image(tiles['RA'], tiles['DEC'], grid)
+        sources['shared_footprint'] = dict(image=[footprint.tolist()])
+    else:
+        sources['shared_footprint'] = dict(
+            RA=np.round(np.array(tiles['RA'], dtype=float), 4).tolist(),
+            DEC=np.round(np.array(tiles['DEC'], dtype=float), 4).tolist(),
+            )
+    for attribute, (hist, edges) in survey_hists.items():
+        sources['shared_hist_'+attribute] = dict(
+            top=np.round(hist, 6).tolist(),
+            left=edges[:-1].tolist(),
+            right=edges[1:].tolist(),
+            )
+
+    outfile = os.path.join(outdir, 'shared_data.js')
+    with open(outfile, 'w') as fp:
+        fp.write("load_shared_data({})".format(json.dumps(sources, separators=(',', ':'))))
+
+    print('Wrote {}'.format(outfile))
+
+#- Columns of the exposures shown in the timeseries plots
+timeseries_columns = ['EXPID', 'TIME', 'AIRMASS', 'SEEING', 'EXPTIME', 'TRANSP', 'SKY', 'HOURANGLE']
+
+def get_night_components(night, exposures, tiles, night_index=None, moonloc=None, survey_hists=None, external_data=False, raster_sky=False):
     '''
-    Generates summary plots for the DESI survey QA
+    Generates the plots of a nightly page
 
     Args:
         night : String representing a single value in the NIGHT column of the EXPOSURES table
         exposures: Table of exposures with columns ...
         tiles: Table of tile locations with columns ...
-        outdir: directory to write the files
-
-    Writes outdir/night-*.html
-    '''
 
-    #getting path for the previous and next night links, first and last night links, link back to summary page
-    #[prev_str, next_str] = get_night_link(night, exposures)
-    #first_str = get_night_link(exposures['NIGHT'][0], exposures)[0]
-    #last_str = get_night_link(exposures['NIGHT'][-1], exposures)[1]
-    summary_str = "summary.html"
-
-    #- Separate calibration exposures
-    all_exposures = exposures[exposures['PROGRAM'] != 'CALIB']
-    all_calibs = exposures[exposures['PROGRAM'] == 'CALIB']
+    Options:
+        night_index, moonloc, survey_hists, external_data, raster_sky: see makeplots
 
-    #- Filter exposures to just this night and adds columns DATETIME and MJD_hour
-    exposures = find_night(all_exposures, night)
-    calibs = find_night(all_calibs, night)
+    Returns dict of the (script, div) components of the plots, keyed by the
+    names of the variables of the nightly.html template
+    '''
+    #- Histograms of all science exposures, for comparison
+    if survey_hists is None:
+        survey_hists = get_survey_hists(exposures)
+
+    #- Filter exposures to just this night, adds column TIME, and separates
+    #- calibration exposures
+    with stage('find_night', night):
+        night_exposures = find_night(exposures, night, night_index)
+    iscalib = (night_exposures['PROGRAM'] == 'CALIB')
+    exposures = night_exposures[~iscalib]
+    calibs = night_exposures[iscalib]
 
     #- Plot options
     #title='Airmass, Seeing, Exptime vs. Time for {}/{}/{}'.format(night[4:6], night[6:], night[:4])
@@ -336,8 +650,7 @@ def makeplots(night, exposures, tiles, outdir):
                 ("Exposure Time", "@EXPTIME"), ("Transparency", "@TRANSP"), ("HOURANGLE", "@HOURANGLE")]
 
     #- Create ColumnDataSource for linking timeseries plots
-    COLS = ['EXPID', 'TIME', 'AIRMASS', 'SEEING', 'EXPTIME', 'TRANSP', 'SKY', 'HOURANGLE']
-    src = ColumnDataSource(data={c:np.array(exposures[c]) for c in COLS})
+    src = ColumnDataSource(data={c:np.array(exposures[c]) for c in timeseries_columns}, name='night_exposures')
 
     #- Get timeseries plots for several variables
     min_border_right_time = 0
@@ -351,244 +664,50 @@ def makeplots(night, exposures, tiles, outdir):
 
     time_hist_plot_height = 160
 
-    airmass = plot_timeseries(src, 'AIRMASS', 'green', tools=TOOLS, x_range=None, title=None, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
-    seeing = plot_timeseries(src, 'SEEING', 'navy', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
-    exptime = plot_timeseries(src, 'EXPTIME', 'darkorange', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
-    transp = plot_timeseries(src, 'TRANSP', 'purple', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
-    hourangle = plot_timeseries(src, 'HOURANGLE', 'maroon', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
-    brightness = plot_timeseries(src, 'SKY', 'pink', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
+    with stage('plot_timeseries', night):
+        airmass = plot_timeseries(src, 'AIRMASS', 'green', tools=TOOLS, x_range=None, title=None, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
+        seeing = plot_timeseries(src, 'SEEING', 'navy', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
+        exptime = plot_timeseries(src, 'EXPTIME', 'darkorange', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
+        transp = plot_timeseries(src, 'TRANSP', 'purple', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
+        hourangle = plot_timeseries(src, 'HOURANGLE', 'maroon', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
+        brightness = plot_timeseries(src, 'SKY', 'pink', tools=TOOLS, x_range=airmass.x_range, tooltips=TOOLTIPS, width=600, height=time_hist_plot_height, min_border_left=min_border_left_time, min_border_right=min_border_right_time)
 
     #- Convert these to the components to include in the HTML
-    timeseries_script, timeseries_div = components(bk.Column(airmass, seeing, exptime, transp, hourangle, brightness))
+    with stage('components', night):
+        timeseries_script, timeseries_div = components(bk.Column(airmass, seeing, exptime, transp, hourangle, brightness))
 
     #making the nightly table of values
-    nightlytable = get_nightlytable(exposures)
-    table_script, table_div = components(nightlytable)
+    with stage('get_nightlytable', night):
+        nightlytable = get_nightlytable(exposures)
+    with stage('components', night):
+        table_script, table_div = components(nightlytable)
 
     #adding in the skyplot components
-    skypathplot = get_skypathplot(exposures, tiles, width=600, height=250, min_border_left=min_border_left_sky, min_border_right=min_border_right_sky)
-    skypathplot_script, skypathplot_div = components(skypathplot)
+    with stage('get_skypathplot', night):
+        skypathplot = get_skypathplot(exposures, tiles, width=600, height=250, min_border_left=min_border_left_sky, min_border_right=min_border_right_sky, moonloc=moonloc, external_data=external_data, rasterize=raster_sky)
+    with stage('components', night):
+        skypathplot_script, skypathplot_div = components(skypathplot)
 
     #adding in the components of the exposure types bar plot
-    exptypecounts = get_exptype_counts(exposures, calibs, width=250, height=250, min_border_left=min_border_left_count, min_border_right=min_border_right_count)
-    exptypecounts_script, exptypecounts_div = components(exptypecounts)
+    with stage('get_exptype_counts', night):
+        exptypecounts = get_exptype_counts(exposures, calibs, width=250, height=250, min_border_left=min_border_left_count, min_border_right=min_border_right_count)
+    with stage('components', night):
+        exptypecounts_script, exptypecounts_div = components(exptypecounts)
 
     #- Get overlaid histograms for several variables
-    airmasshist = overlaid_hist(all_exposures, exposures, 'AIRMASS', 'green', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist)
-    seeinghist = overlaid_hist(all_exposures, exposures, 'SEEING', 'navy', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist)
-    exptimehist = overlaid_hist(all_exposures, exposures, 'EXPTIME', 'darkorange', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist)
-    transphist = overlaid_hist(all_exposures, exposures, 'TRANSP', 'purple', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist)
-    houranglehist = overlaid_hist(all_exposures, exposures, 'HOURANGLE', 'maroon', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist)
-    brightnesshist = overlaid_hist(all_exposures, exposures, 'SKY', 'pink', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist)
+    with stage('overlaid_hist', night):
+        airmasshist = overlaid_hist(None, exposures, 'AIRMASS', 'green', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist, all_hist=survey_hists['AIRMASS'], external_data=external_data)
+        seeinghist = overlaid_hist(None, exposures, 'SEEING', 'navy', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist, all_hist=survey_hists['SEEING'], external_data=external_data)
+        exptimehist = overlaid_hist(None, exposures, 'EXPTIME', 'darkorange', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist, all_hist=survey_hists['EXPTIME'], external_data=external_data)
+        transphist = overlaid_hist(None, exposures, 'TRANSP', 'purple', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist, all_hist=survey_hists['TRANSP'], external_data=external_data)
+        houranglehist = overlaid_hist(None, exposures, 'HOURANGLE', 'maroon', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist, all_hist=survey_hists['HOURANGLE'], external_data=external_data)
+        brightnesshist = overlaid_hist(None, exposures, 'SKY', 'pink', 250, time_hist_plot_height, min_border_left=min_border_left_hist, min_border_right=min_border_right_hist, all_hist=survey_hists['SKY'], external_data=external_data)
 
     #adding in the components of the overlaid histograms
-    overlaidhists_script, overlaidhists_div = components(bk.Column(airmasshist, seeinghist, exptimehist, transphist, houranglehist, brightnesshist))
-
-
-    #----
-    #- Template HTML for this page
-
-    #- Generate HTML header separately so that we can get the right bokeh
-    #- version in there without mucking up the python string formatting
-
-    header = """
-    <!DOCTYPE html>
-    <html lang="en-US">
-
-    <link
-        href="https://cdn.pydata.org/bokeh/release/bokeh-{version}.min.css"
-        rel="stylesheet" type="text/css"
-    >
-    <link
-        href="https://cdn.pydata.org/bokeh/release/bokeh-tables-{version}.min.css"
-        rel="stylesheet" type="text/css"
-    >
-    <script
-        src="https://cdn.pydata.org/bokeh/release/bokeh-{version}.min.js"
-    ></script>
-
-    <script src="https://cdn.pydata.org/bokeh/release/bokeh-tables-{version}.min.js"
-    ></script>
-
-    <script type="text/javascript">
-    if (typeof Bokeh == 'undefined')
-    {{
-        document.write("<link href='offline_files/bokeh-{version}.css' rel='stylesheet' type='text/css'>");
-        document.write("<link href='offline_files/bokeh_tables-{version}.css' rel='stylesheet' type='text/css'>");
-        document.write("<script src='offline_files/bokeh-{version}.js' type='text/javascript'><\/script>");
-        document.write("<script src='offline_files/bokeh_tables-{version}.js' type='text/javascript'><\/script>");
-    }}
-    </script>
-
-    """.format(version=bokeh.__version__)
-
-
-    #- CSS styling
-    template = header + """
-    <head>
-    <style>
-    body {
-        margin: 0;
-    }
-
-    .header {
-        font-family: "Open Serif", Arial, Helvetica, sans-serif;
-        background-color: #f1f1f1;
-        padding: 10px;
-        text-align: center;
-        justify: space-around;
-    }
-
-    .column {
-        float: center;
-        padding: 10px
-    }
-
-    .column.side {
-        width = 5%;
-    }
-
-    .column.middle {
-        width = 90%;
-    }
-
-    .flex-container {
-        display: flex;
-        flex-direction: row;
-        flex-flow: row wrap;
-        justify-content: center;
-        padding: 10px;
-    }
-
-    p.sansserif {
-        font-family: "Open Serif", Helvetica, sans-serif;
-    }
-
-    ul {
-      list-style-type: none;
-      margin: 0;
-      padding: 0;
-      overflow: hidden;
-      background-color: #333;
-    }
-
-    li {
-      float: right;
-    }
-
-    li a {
-      display: block;
-      color: white;
-      text-align: center;
-      padding: 20px;
-      text-decoration: none;
-      font-family: "Open Serif", "Arial", sans-serif;
-    }
-
-    li a:hover {
-      background-color: #111;
-    }
-
-    li a.noHover{
-      pointer-events: none;
-    }
-    </style>
-    </head>
-    """
-
-# TODO: this the the navigation link template without hrefs
-#       to be updated later, but that conceptually conflicts with
-#       and earlier PR that was handling the prev/next links on
-#       the first/last nights
-#
-#     template += """
-#     <body>
-#         <ul>
-#           <li style="float:left"><a>DESI Survey QA Night {}</a></li>
-#           <li><a id="last">Last</a></li>
-#           <li><a id="next">Next</a></li>
-#           <li><a id="prev">Previous</a></li>
-#           <li><a id="first">First</a></li>
-#           <li><a href={}>Summary Page</a></li>
-#         </ul>
-#     """.format(night, summary_str)
-
-# TODO: this is the link code from the earlier PR
-
-    # Navigation links, with grayed out Previous link on first night,
-    # and similarly for Next link on last night.
-    # Put links in dict to use for formatting since different cases need
-    # different combinations of links
-    night_str = "night-{}.html".format(night)
-    navigation_links = dict(
-            night=night,
-            summaryfile=summary_str
-            )
+    with stage('components', night):
+        overlaidhists_script, overlaidhists_div = components(bk.Column(airmasshist, seeinghist, exptimehist, transphist, houranglehist, brightnesshist))
 
-    template += """
-    <body>
-        <ul>
-          <li style="float:left"><a>DESI Survey QA Night {night}</a></li>
-          <li><a id="last">Last</a></li>
-          <li><a id="next">Next</a></li>
-          <li><a id="prev">Previous</a></li>
-          <li><a id="first">First</a></li>
-          <li><a href={summaryfile}>Summary Page</a></li>
-        </ul>
-    """.format(**navigation_links)
-
-# TODO: this is the code that updates the hrefs
-
-    #- Update the navigation hrefs using the cached valus in linking.js
-    template += """
-    <script>
-        function get_linking_json_dict(dict) {
-            document.getElementById("last").href = dict.last;
-            document.getElementById("first").href = dict.first;
-            var next_prev = dict.n"""+night+""";
-
-            var next_item = next_prev.next;
-            if (next_item=="none") {
-                document.getElementById("next").className = "noHover";
-            } else {
-                document.getElementById("next").href = next_prev.next;
-            }
-
-            var prev_item = next_prev.prev;
-            if (prev_item=="none") {
-                document.getElementById("prev").className = "noHover";
-            } else {
-                document.getElementById("prev").href = next_prev.prev;
-            }
-        }
-    </script>
-    <script src="linking.js"></script>
-    """
-
-    #- Now add the HTML body with template placeholders for plots
-    template += """
-        <div class="flex-container">
-                <div class="column middle">
-                    <div class="flex-container">
-                        <div>{{ skypathplot_script }} {{ skypathplot_div}}</div>
-                        <div>{{ exptypecounts_script }} {{ exptypecounts_div }}</div>
-                    </div>
-
-                    <div class="flex-container">
-                        <div>{{ timeseries_script }} {{ timeseries_div }}</div>
-                        <div>{{ overlaidhists_script }} {{ overlaidhists_div }}</div>
-                    </div>
-
-                    <div class="flex-container">{{ table_script }}{{ table_div }}</div>
-                </div>
-            </div>
-    </body>
-
-    </html>
-    """
-
-    #- Convert to a jinja2.Template object and render HTML
-    html = jinja2.Template(template).render(
+    return dict(
         skypathplot_script=skypathplot_script, skypathplot_div=skypathplot_div,
         exptypecounts_script=exptypecounts_script, exptypecounts_div=exptypecounts_div,
         timeseries_script=timeseries_script, timeseries_div=timeseries_div,
@@ -596,23 +715,181 @@ def makeplots(night, exposures, tiles, outdir):
         table_script=table_script, table_div=table_div,
         )
 
+def makeplots(night, exposures, tiles, outdir, night_index=None, moonloc=None, survey_hists=None, external_data=False, raster_sky=False):
+    '''
+    Generates summary plots for the DESI survey QA
+
+    Args:
+        night : String representing a single value in the NIGHT column of the EXPOSURES table
+        exposures: Table of exposures with columns ...
+        tiles: Table of tile locations with columns ...
+        outdir: directory to write the files
+
+    Options:
+        night_index: dict of slices from get_night_index(exposures), to select
+            the exposures of this night without scanning the full table
+        moonloc: (ra, dec) of the moon on this night, e.g. from get_moonlocs
+        survey_hists: histograms of all exposures from get_survey_hists;
+            computed from exposures if not given
+        external_data: if True, load the tile footprint and the histograms
+            of all exposures from outdir/shared_data.js written by
+            write_shared_data, instead of embedding them in the page
+        raster_sky: if True, show the tile footprint as an image instead of
+            a point per tile (see get_skypathplot); with external_data, it
+            must match the raster_sky of write_shared_data
+
+    Writes outdir/night-*.html
+    '''
+    values = get_night_components(night, exposures, tiles, night_index=night_index,
+        moonloc=moonloc, survey_hists=survey_hists, external_data=external_data,
+        raster_sky=raster_sky)
+
+    #- Render the HTML from the nightly page template
+    with stage('render', night):
+        html = surveyqa.render.render('nightly.html', night=night,
+            summaryfile="summary.html", external_data=external_data, **values)
+
     #- Write output file for this night
     outfile = os.path.join(outdir, 'night-{}.html'.format(night))
+    with stage('write', night):
+        with open(outfile, 'w') as fx:
+            fx.write(html)
+    print('Wrote {}'.format(outfile))
+
+def get_night_data(night, exposures, tiles, night_index=None, moonloc=None, survey_hists=None):
+    '''
+    Computes the values of the named per-night models of a nightly page, so
+    that a page made for one night can show another by swapping them
+
+    Args:
+        night : String representing a single value in the NIGHT column of the EXPOSURES table
+        exposures: Table of exposures with columns ...
+        tiles: Table of tile locations with columns ...
+
+    Options:
+        night_index, moonloc, survey_hists: see makeplots
+
+    Returns dict keyed by model name of dicts of model properties, e.g.
+    {'night_table': {'data': {...}}, 'night_skypath_title': {'text': ...}}
+    '''
+    if survey_hists is None:
+        survey_hists = get_survey_hists(exposures)
+
+    night_exposures = find_night(exposures, night, night_index)
+    iscalib = (night_exposures['PROGRAM'] == 'CALIB')
+    exposures = night_exposures[~iscalib]
+    calibs = night_exposures[iscalib]
+
+    models = dict()
+    models['night_exposures'] = dict(data={c:np.array(exposures[c]) for c in timeseries_columns})
+    models['night_table'] = dict(data=get_nightlytable_data(exposures))
+    for name, data in get_skypath_data(exposures, tiles, moonloc).items():
+        models[name] = dict(data=data)
+    models['night_skypath_title'] = dict(text=get_skypath_title(night))
+
+    exptype = get_exptype_data(exposures, calibs)
+    models['night_exptype_counts'] = dict(data=exptype)
+    models['night_exptype_range'] = dict(start=0, end=np.max(exptype['counts'])*1.15)
+
+    for attribute, (hist_all, edges_all) in survey_hists.items():
+        hist, edges = get_attribute_hist(exposures[attribute], edges_all)
+        models['night_hist_'+attribute] = dict(data=dict(top=hist, left=edges[:-1], right=edges[1:]))
+
+    return models
+
+def _to_json(value):
+    '''
+    Converts VALUE (nested dicts, lists and numpy arrays) to JSON-compatible
+    types, with datetime64 converted to milliseconds since the epoch like
+    bokeh does for ColumnDataSource data
+    '''
+    if isinstance(value, dict):
+        return {key: _to_json(x) for key, x in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_to_json(x) for x in value]
+    elif isinstance(value, np.ndarray):
+        if np.issubdtype(value.dtype, np.datetime64):
+            value = value.astype('datetime64[ns]').astype(np.int64) / 1e6
+        elif value.dtype.kind == 'S':
+            value = value.astype(str)
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    else:
+        return value
+
+def write_night_data(night, exposures, tiles, outdir, night_index=None, moonloc=None, survey_hists=None):
+    '''
+    Writes the data bundle of one night for the single page dashboard (see
+    write_dashboard)
+
+    Args:
+        night : String representing a single value in the NIGHT column of the EXPOSURES table
+        exposures: Table of exposures with columns ...
+        tiles: Table of tile locations with columns ...
+        outdir: directory to write the files
+
+    Options:
+        night_index, moonloc, survey_hists: see makeplots
+
+    Writes outdir/nights/night-NIGHT.js, which calls the javascript function
+    `load_night_data` with the night and the values from get_night_data
+    '''
+    with stage('get_night_data', night):
+        models = get_night_data(night, exposures, tiles, night_index=night_index,
+            moonloc=moonloc, survey_hists=survey_hists)
+
+    os.makedirs(os.path.join(outdir, 'nights'), exist_ok=True)
+    outfile = os.path.join(outdir, 'nights', 'night-{}.js'.format(night))
+    with stage('write', night):
+        with open(outfile, 'w') as fx:
+            fx.write('load_night_data("{}", {})'.format(night,
+                json.dumps(_to_json(models), separators=(',', ':'))))
+
+    print('Wrote {}'.format(outfile))
+
+def write_dashboard(night, nights, exposures, tiles, outdir, night_index=None, moonloc=None, survey_hists=None, raster_sky=False):
+    '''
+    Writes the single page dashboard of the nightly QA, which shows the night
+    selected in the URL (dashboard.html#YEARMMDD) by loading its data bundle
+    from outdir/nights/ (see write_night_data)
+
+    Args:
+        night : night that the figures are made for; its data are shown until
+            the bundle of the night to show is loaded
+        nights : list of nights with data bundles, in order; the page shows
+            the last of them unless another is selected in the URL
+        exposures: Table of exposures with columns ...
+        tiles: Table of tile locations with columns ...
+        outdir: directory to write the files
+
+    Options:
+        night_index, moonloc, survey_hists, raster_sky: see makeplots
+
+    Writes outdir/dashboard.html
+    '''
+    values = get_night_components(night, exposures, tiles, night_index=night_index,
+        moonloc=moonloc, survey_hists=survey_hists, raster_sky=raster_sky)
+
+    with stage('render', 'dashboard'):
+        html = surveyqa.render.render('dashboard.html', night=night, nights=list(nights),
+            summaryfile="summary.html", **values)
+
+    outfile = os.path.join(outdir, 'dashboard.html')
     with open(outfile, 'w') as fx:
         fx.write(html)
     print('Wrote {}'.format(outfile))
 
-def get_exptype_counts(exposures, calibs, width=300, height=300, min_border_left=50, min_border_right=50):
+def get_exptype_data(exposures, calibs):
     """
-    Generate a horizontal bar plot showing the counts for each type of
-    exposure grouped by whether they have FLAVOR='science' or PROGRAM='calib'
+    Counts the exposures of each type for get_exptype_counts
 
     ARGS:
         exposures : a table of exposures which only contain those with FLAVOR='science'
         calibs : a table of exposures which only contains those with PROGRAm='calibs'
-    Options:
-        height, width: height and width in pixels
-        min_border_left, min_border_right = set minimum width of surrounding labels (in pixels)
+
+    Returns dict with the list of (category, type) factors 'types' and the
+    array of their 'counts'
     """
     darks = len(exposures[exposures['PROGRAM'] == 'DARK'])
     grays = len(exposures[exposures['PROGRAM'] == 'GRAY'])
@@ -625,12 +902,29 @@ def get_exptype_counts(exposures, calibs, width=300, height=300, min_border_left
     types = [('calib', 'ZERO'), ('calib', 'FLAT'), ('calib', 'ARC'),
             ('science', 'BRIGHT'), ('science', 'GRAY'), ('science', 'DARK')]
     counts = np.array([zeroes, flats, arcs, brights, grays, darks])
+
+    return {'types':types, 'counts':counts}
+
+def get_exptype_counts(exposures, calibs, width=300, height=300, min_border_left=50, min_border_right=50):
+    """
+    Generate a horizontal bar plot showing the counts for each type of
+    exposure grouped by whether they have FLAVOR='science' or PROGRAM='calib'
+
+    ARGS:
+        exposures : a table of exposures which only contain those with FLAVOR='science'
+        calibs : a table of exposures which only contains those with PROGRAm='calibs'
+    Options:
+        height, width: height and width in pixels
+        min_border_left, min_border_right = set minimum width of surrounding labels (in pixels)
+    """
+    data = get_exptype_data(exposures, calibs)
+    types = data['types']
     COLORS = ['tan', 'orange', 'yellow', 'green', 'blue', 'red']
 
-    src = ColumnDataSource({'types':types, 'counts':counts})
+    src = ColumnDataSource(data, name='night_exptype_counts')
 
     p = bk.figure(width=width, height=height,
-                   x_range=(0, np.max(counts)*1.15),
+                   x_range=Range1d(0, np.max(data['counts'])*1.15, name='night_exptype_range'),
                   y_range=FactorRange(*types), title='Exposure Type Counts',
                   toolbar_location=None, min_border_left=min_border_left, min_border_right=min_border_right)
     p.hbar(y='types', right='counts', left=0, height=0.5, line_color='white',
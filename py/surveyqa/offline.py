@@ -0,0 +1,17 @@
+"""
+Offline astropy time and coordinate calculations
+"""
+
+import contextlib
+from astropy.utils import iers
+
+@contextlib.contextmanager
+def offline_iers():
+    '''
+    Context manager that uses the IERS and leap second tables bundled with
+    astropy within its block instead of downloading the latest ones, so
+    that the QA runs offline.  The astropy configuration is restored at the
+    end of the block, leaving that of the calling code alone.
+    '''
+    with iers.conf.set_temp('auto_download', False):
+        yield
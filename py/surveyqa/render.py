@@ -0,0 +1,40 @@
+"""
+Rendering of the QA pages from the jinja2 templates in surveyqa/templates
+"""
+
+import os
+import jinja2
+import bokeh
+
+#- Created on first use in each (worker) process; the environment keeps the
+#- compiled templates, so each template is only compiled once per process
+_environment = None
+
+def get_environment():
+    '''
+    Returns the jinja2 Environment that loads the surveyqa page templates
+    '''
+    global _environment
+    if _environment is None:
+        templatedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+        #- auto_reload=False: don't check the template files for changes
+        #- every time a page is rendered
+        _environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(templatedir), auto_reload=False)
+        _environment.globals['bokeh_version'] = bokeh.__version__
+        #- Bokeh 2 and later have no separate .css files
+        _environment.globals['bokeh_css'] = int(bokeh.__version__.split('.')[0]) < 2
+
+    return _environment
+
+def render(name, **values):
+    '''
+    Renders a page template
+
+    Args:
+        name: template filename in surveyqa/templates, e.g. 'nightly.html'
+        values: values of the template variables
+
+    Returns HTML string
+    '''
+    return get_environment().get_template(name).render(**values)
@@ -0,0 +1,110 @@
+"""
+Rasterized sky maps, binned server-side so that large sets of tiles are sent
+to the browser as a single image instead of one glyph per tile
+"""
+
+import numpy as np
+
+from bokeh.models import ColumnDataSource, LinearColorMapper
+
+#- Default size of the pixels of the sky images in degrees
+default_pixsize = 1.0
+
+#- Color of the empty pixels
+transparent = (0, 0, 0, 0)
+
+def get_sky_grid(tiles, pixsize=default_pixsize):
+    '''
+    Returns the pixel grid of the sky images of TILES
+
+    Args:
+        tiles: Table of tile locations with columns RA, DEC
+
+    Options:
+        pixsize: size of the pixels in degrees
+
+    Returns (ra_edges, dec_edges) arrays of the pixel edges, covering all
+    RA and the DEC range of the tiles rounded out to whole pixels
+    '''
+    nra = int(round(360.0 / pixsize))
+    ra_edges = np.linspace(0.0, 360.0, nra+1)
+
+    dec = np.asarray(tiles['DEC'], dtype=float)
+    decmin = np.floor(dec.min() / pixsize) * pixsize
+    decmax = max(np.ceil(dec.max() / pixsize) * pixsize, decmin + pixsize)
+    ndec = int(round((decmax - decmin) / pixsize))
+    dec_edges = np.linspace(decmin, decmax, ndec+1)
+
+    return ra_edges, dec_edges
+
+def get_sky_image(ra, dec, grid, weights=None):
+    '''
+    Bins positions on the sky into an image
+
+    Args:
+        ra, dec: arrays of positions in degrees
+        grid: (ra_edges, dec_edges) from get_sky_grid
+
+    Options:
+        weights: array of weights of the positions
+
+    Returns 2D array of the number (or sum of weights) of the positions in
+    each pixel, with DEC along the first axis as bokeh images expect
+    '''
+    ra_edges, dec_edges = grid
+    ra = np.asarray(ra, dtype=float) % 360.0
+    dec = np.asarray(dec, dtype=float)
+    image, _, _ = np.histogram2d(dec, ra, bins=(dec_edges, ra_edges), weights=weights)
+    return image
+
+def get_footprint_image(ra, dec, grid):
+    '''
+    Returns uint8 image of GRID that is 1 in the pixels with any of the
+    positions RA, DEC and 0 elsewhere
+    '''
+    return (get_sky_image(ra, dec, grid) > 0).astype(np.uint8)
+
+def get_mean_image(ra, dec, values, grid):
+    '''
+    Returns float32 image of GRID with the mean of VALUES at the positions
+    RA, DEC in each pixel, and NaN in the pixels without any position
+    '''
+    counts = get_sky_image(ra, dec, grid)
+    sums = get_sky_image(ra, dec, grid, weights=np.asarray(values, dtype=float))
+    image = np.full(counts.shape, np.nan, dtype=np.float32)
+    filled = counts > 0
+    image[filled] = sums[filled] / counts[filled]
+    return image
+
+def get_footprint_mapper(color='gray'):
+    '''
+    Returns a color mapper that shows the 1 pixels of a footprint image in
+    COLOR and the 0 pixels as transparent
+    '''
+    return LinearColorMapper(palette=[color], low=0.5, high=1.0,
+                             low_color=transparent, nan_color=transparent)
+
+def plot_sky_image(fig, image, grid, color_mapper, name=None, alpha=1.0):
+    '''
+    Adds a sky image to a figure
+
+    Args:
+        fig: bokeh Figure
+        image: 2D array from e.g. get_footprint_image or get_mean_image; may
+            be None to leave the image empty, to be filled in by name later
+        grid: (ra_edges, dec_edges) from get_sky_grid
+        color_mapper: bokeh color mapper of the image values
+
+    Options:
+        name: name of the ColumnDataSource of the image
+        alpha: opacity of the image
+
+    Returns the bokeh GlyphRenderer of the image
+    '''
+    ra_edges, dec_edges = grid
+    images = [] if image is None else [image]
+    source = ColumnDataSource(data=dict(image=images), name=name)
+    return fig.image(image='image', source=source, color_mapper=color_mapper,
+                     x=ra_edges[0], y=dec_edges[0],
+                     dw=ra_edges[-1]-ra_edges[0], dh=dec_edges[-1]-dec_edges[0],
+                     global_alpha=alpha)
@@ -5,7 +5,6 @@ Summary plots of DESI survey progress and QA
 import sys, os
 import numpy as np
 
-import jinja2
 from bokeh.embed import components
 import bokeh
 import bokeh.plotting as bk
@@ -14,43 +13,185 @@ from bokeh.models.widgets import NumberFormatter
 from bokeh.models.widgets.tables import DataTable, TableColumn
 from bokeh.layouts import gridplot
 from bokeh.transform import transform
-from astropy.time import Time, TimezoneInfo
-from astropy.table import Table, join
-from datetime import datetime, tzinfo, timedelta
+from astropy.time import Time
 import astropy.units as u
 from collections import Counter, OrderedDict
 from pathlib import PurePath
 
+from surveyqa.timing import stage
+import surveyqa.render
+import surveyqa.skyimage
+from surveyqa.offline import offline_iers
+
 #- Avoid warnings from date & coord calculations in the future
 import warnings
 warnings.filterwarnings('ignore', 'ERFA function.*dubious year.*')
 warnings.filterwarnings('ignore', 'Tried to get polar motions for times after IERS data is valid.*')
 
-def nights_first_observed(exposures, tiles):
+def get_tile_stats(exposures):
+    '''
+    Aggregates the science exposures of each tile in a single pass, sorting
+    the exposures by TILEID once and reducing each block of rows, so that
+    the summary figures do not each group the exposures by tile
+
+    Args:
+        exposures: Table of exposures with columns PROGRAM, TILEID, MJD,
+            NIGHT, EXPID, EXPTIME
+
+    Returns dict of arrays with one entry per observed tile, keyed by
+        "TILEID": sorted unique TILEIDs
+        "PROGRAM": PROGRAM of the first exposure of the tile (strings)
+        "NEXP": number of exposures
+        "EXPTIME": total exposure time in seconds
+        "FIRST_ROW", "LAST_ROW": rows in exposures of the first and last
+            exposure of the tile, in the order of the exposures table
+        "FIRST_MJD", "FIRST_NIGHT", "FIRST_EXPID": of the first exposure
+        "LAST_MJD": latest MJD of the exposures of the tile
+
+    CALIB exposures are not included.
+    '''
+    rows = np.flatnonzero(exposures['PROGRAM'] != 'CALIB')
+    tileid = np.asarray(exposures['TILEID'])[rows]
+    order = np.argsort(tileid, kind='stable')
+    rows = rows[order]
+    tileid = tileid[order]
+
+    #- First row of each block of exposures of the same tile
+    start = np.flatnonzero(np.concatenate([[True], tileid[1:] != tileid[:-1]]))[0:len(rows)]
+    nexp = np.diff(np.concatenate([start, [len(rows)]]))
+    first = rows[start]
+    last = rows[start + nexp - 1]
+
+    mjd = np.asarray(exposures['MJD'], dtype=float)[rows]
+    exptime = np.asarray(exposures['EXPTIME'], dtype=float)[rows]
+    if len(rows) > 0:
+        total_exptime = np.add.reduceat(exptime, start)
+        last_mjd = np.maximum.reduceat(mjd, start)
+    else:
+        total_exptime = np.zeros(0)
+        last_mjd = np.zeros(0)
+
+    return dict(
+        TILEID = tileid[start],
+        PROGRAM = np.asarray(exposures['PROGRAM'])[first].astype(str),
+        NEXP = nexp,
+        EXPTIME = total_exptime,
+        FIRST_ROW = first,
+        LAST_ROW = last,
+        FIRST_MJD = np.asarray(exposures['MJD'], dtype=float)[first],
+        FIRST_NIGHT = np.asarray(exposures['NIGHT'])[first],
+        FIRST_EXPID = np.asarray(exposures['EXPID'])[first],
+        LAST_MJD = last_mjd,
+        )
+
+def update_tile_stats(tile_stats, new_stats):
+    '''
+    Merges the per-tile aggregates of exposures appended to a table into
+    those of the table, without regrouping the full table
+
+    Args:
+        tile_stats: per-tile aggregates of the table from get_tile_stats
+        new_stats: per-tile aggregates of the appended exposures, with
+            FIRST_ROW and LAST_ROW already offset to rows of the full table
+
+    Returns dict of arrays like get_tile_stats of the full table
+    '''
+    stats = {key: np.concatenate([tile_stats[key], new_stats[key]]) for key in tile_stats}
+    if len(stats['TILEID']) == 0:
+        return stats
+
+    #- Sort stably so that the entry of the table comes before the entry of
+    #- the appended exposures of the same tile, then reduce each block
+    order = np.argsort(stats['TILEID'], kind='stable')
+    stats = {key: value[order] for key, value in stats.items()}
+    tileid = stats['TILEID']
+    start = np.flatnonzero(np.concatenate([[True], tileid[1:] != tileid[:-1]]))
+    end = np.concatenate([start[1:], [len(tileid)]]) - 1
+
+    merged = {key: stats[key][start] for key in stats}
+    merged['NEXP'] = np.add.reduceat(stats['NEXP'], start)
+    merged['EXPTIME'] = np.add.reduceat(stats['EXPTIME'], start)
+    merged['LAST_ROW'] = stats['LAST_ROW'][end]
+    merged['LAST_MJD'] = np.maximum.reduceat(stats['LAST_MJD'], start)
+    return merged
+
+def nights_first_observed(exposures, tiles, tile_stats=None):
     '''
     Generates a list of the first night on which each tile was observed (mainly for use in color coding the skyplot).
-    Uses numpy.unique, numpy.array
 
     Args:
         exposures: Table of exposures with columns ...
         tiles: Table of tile locations with columns...
 
+    Options:
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
+
     Returns two arrays:
         array of float values (meaning exact time of first exposure taken)
         array of integer values (the night, not the exact time)'''
+    if tile_stats is None:
+        tile_stats = get_tile_stats(exposures)
 
-    tiles_unique, indx = np.unique(exposures['TILEID'], return_index=True)
-    nights = exposures['MJD'][indx]
-    nights = nights[1:len(nights)]
-    nights_int = np.array(nights.astype(int))
+    nights = tile_stats['FIRST_MJD']
+    nights_int = nights.astype(int)
 
     return nights, nights_int
 
-def get_skyplot(exposures, tiles, width=500, height=250, min_border_left=50, min_border_right=50):
+def get_tile_index(tiles):
+    '''
+    Returns an index of the tiles by TILEID, for lookups with searchsorted
+
+    Args:
+        tiles: Table of tile locations with column "TILEID"
+
+    Returns (order, tileid): tiles['TILEID'][order] is sorted, and tileid is
+    that sorted array
+
+    The figures of tiles take the index as their tile_index option, so that
+    it can be computed once per run and shared by them.
+    '''
+    order = np.argsort(tiles['TILEID'], kind='stable')
+    return order, np.asarray(tiles['TILEID'])[order]
+
+def get_first_exposures(exposures, tiles, tile_stats=None, tile_index=None):
+    '''
+    Finds the first science exposure of each tile
+
+    Args:
+        exposures: Table of exposures with columns "PROGRAM", "TILEID"
+        tiles: Table of tile locations with column "TILEID"
+
+    Options:
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
+        tile_index: index of tiles from get_tile_index; computed if not given
+
+    Returns integer array of the rows in exposures of the first exposure of
+    each tile, in the TILEID order of get_tile_index, with -1 for the tiles
+    that were not observed
+    '''
+    if tile_stats is None:
+        tile_stats = get_tile_stats(exposures)
+    if tile_index is None:
+        tile_index = get_tile_index(tiles)
+    order, tileid = tile_index
+
+    #- Keep the observed tiles that are in the tiles table
+    observed = tile_stats['TILEID']
+    pos = np.searchsorted(tileid, observed).clip(0, max(len(tileid)-1, 0))
+    match = (tileid[pos] == observed) if len(tileid) > 0 else np.zeros(len(observed), dtype=bool)
+
+    first_rows = np.full(len(tileid), -1, dtype=np.int64)
+    first_rows[pos[match]] = tile_stats['FIRST_ROW'][match]
+    return first_rows
+
+def get_skyplot(exposures, tiles, width=500, height=250, min_border_left=50, min_border_right=50, rasterize=False, tile_stats=None,
+                tile_index=None):
     '''
     Generates sky plot of DESI survey tiles and progress. Colorcoded by night each tile was first
-    observed, uses nights_first_observed function defined previously in this module to retrieve
-    night each tile was first observed.
+    observed, uses get_first_exposures defined previously in this module to retrieve
+    the first exposure of each tile.
 
     Args:
         exposures: Table of exposures with columns ...
@@ -59,50 +200,99 @@ def get_skyplot(exposures, tiles, width=500, height=250, min_border_left=50, min
     Options:
         width, height: plot width and height in pixels
         min_border_left, min_border_right: set minimum width for external labels in pixels
+        rasterize: if True, show the tiles as images binned server-side (see
+            surveyqa.skyimage), of the footprint and of the mean MJD of the
+            first exposure of the observed tiles in each pixel; only the
+            tiles first observed on the last night are kept as points
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
+        tile_index: index of tiles from get_tile_index; computed if not given
 
     Returns bokeh Figure object
     '''
-    keep = exposures['PROGRAM'] != 'CALIB'
-    exposures_nocalib = exposures[keep]
-    tiles_sorted = Table(np.sort(tiles, order='TILEID'))
-    observed_tiles = np.in1d(tiles_sorted['TILEID'], exposures_nocalib['TILEID'])
-    observed_exposures = np.in1d(exposures_nocalib['TILEID'], tiles_sorted['TILEID'])
-    tiles_shared = tiles_sorted[observed_tiles]
-    exposures_shared = exposures_nocalib[observed_exposures]
+    if tile_index is None:
+        tile_index = get_tile_index(tiles)
+    order, tileid = tile_index
+    first_rows = get_first_exposures(exposures, tiles, tile_stats, tile_index)
+    observed = first_rows >= 0
+    rows = first_rows[observed]
+
+    #- Compact typed columns, which bokeh serializes as binary arrays
+    ra = np.asarray(tiles['RA'])[order]
+    dec = np.asarray(tiles['DEC'])[order]
+    program = np.asarray(tiles['PROGRAM'])[order].astype(str)
+    tilepass = np.asarray(tiles['PASS'])[order].astype(np.int32)
+    tileid = tileid.astype(np.int32)
+
+    nights_int = np.asarray(exposures['NIGHT'])[rows].astype(np.int32)
+    mjd_int = np.asarray(exposures['MJD'])[rows].astype(np.int32)
+    expid_int = np.asarray(exposures['EXPID'])[rows].astype(np.int32)
+
+    color_mapper = LinearColorMapper(palette="Viridis256", low=mjd_int.min(), high=mjd_int.max(),
+                                     nan_color=surveyqa.skyimage.transparent)
 
-    tiles_unique, indx = np.unique(exposures_shared['TILEID'], return_index=True)
-    nights = exposures_shared['NIGHT'][indx]
-    nights_int = np.array(nights).astype(int)
+    #making figure
+    fig = bk.figure(width=width, height=height, min_border_left=min_border_left, min_border_right=min_border_right)
 
-    mjd = exposures_shared['MJD'][indx]
-    mjd_int = np.array(mjd).astype(int)
+    #- Observed tiles shown as points; only those of the last night if the
+    #- rest are rasterized
+    points = np.ones(len(rows), dtype=bool)
+    if rasterize:
+        grid = surveyqa.skyimage.get_sky_grid(tiles)
+        footprint = surveyqa.skyimage.get_footprint_image(ra, dec, grid)
+        surveyqa.skyimage.plot_sky_image(fig, footprint, grid, surveyqa.skyimage.get_footprint_mapper())
+        first_mjd = surveyqa.skyimage.get_mean_image(ra[observed], dec[observed],
+            np.asarray(exposures['MJD'])[rows], grid)
+        surveyqa.skyimage.plot_sky_image(fig, first_mjd, grid, color_mapper, alpha=0.85)
+        points = (nights_int == nights_int.max())
+    else:
+        source = ColumnDataSource(data=dict(
+            RA = ra,
+            DEC = dec,
+            TILEID = tileid,
+            PROGRAM = program,
+            PASS = tilepass,
+        ))
 
-    expid = exposures_shared['EXPID'][indx]
-    expid_int = np.array(expid).astype(int)
-
-    source = ColumnDataSource(data=dict(
-        RA = tiles_sorted['RA'],
-        DEC = tiles_sorted['DEC'],
-        TILEID = tiles_sorted['TILEID'],
-        PROGRAM = tiles_sorted['PROGRAM'].astype(str),
-        PASS = tiles_sorted['PASS'].astype(int),
-        NIGHT = ["NA" for _ in np.ones(len(tiles['TILEID']))],
-        MJD = ["NA" for _ in np.ones(len(tiles['TILEID']))],
-        EXPID = ["NA" for _ in np.ones(len(tiles['TILEID']))]
-    ))
+        #unobserved tiles
+        tiles_renderer = fig.circle('RA', 'DEC', source=source, color='gray', radius=0.25)
 
     source_obs = ColumnDataSource(data=dict(
-        RA_obs = tiles_shared['RA'],
-        DEC_obs = tiles_shared['DEC'],
-        TILEID = tiles_shared['TILEID'],
-        PROGRAM = tiles_shared['PROGRAM'].astype(str),
-        PASS = tiles_shared['PASS'].astype(int),
-        NIGHT = nights_int,
-        MJD = mjd_int,
-        EXPID = expid_int
+        RA_obs = ra[observed][points],
+        DEC_obs = dec[observed][points],
+        TILEID = tileid[observed][points],
+        PROGRAM = program[observed][points],
+        PASS = tilepass[observed][points],
+        NIGHT = nights_int[points],
+        MJD = mjd_int[points],
+        EXPID = expid_int[points]
     ))
 
-    hover = HoverTool(
+    #observed tiles
+    observed_renderer = fig.circle('RA_obs', 'DEC_obs', color=transform('MJD', color_mapper), size=3, alpha=0.85, source=source_obs)
+    color_bar = ColorBar(color_mapper=color_mapper, label_standoff=12, location=(0,0), title='MJD', width=5)
+    fig.add_layout(color_bar, 'right')
+
+    fig.xaxis.axis_label = 'RA [degrees]'
+    fig.yaxis.axis_label = 'Declination [degrees]'
+    fig.title.text = 'Observed Tiles, Nightly Progress'
+
+    #- Separate hover tools, so that the tiles need no placeholder first
+    #- night and exposure
+    if not rasterize:
+        hover = HoverTool(
+                renderers=[tiles_renderer],
+                tooltips="""
+                    <font face="Arial" size="0">
+                    <font color="blue"> TILEID: </font> @TILEID <br>
+                    <font color="blue"> PROGRAM/PASS: </font> @PROGRAM / @PASS
+                    </font>
+                """
+            )
+        fig.add_tools(hover)
+
+    hover_obs = HoverTool(
+            renderers=[observed_renderer],
             tooltips="""
                 <font face="Arial" size="0">
                 <font color="blue"> TILEID: </font> @TILEID <br>
@@ -112,26 +302,79 @@ def get_skyplot(exposures, tiles, width=500, height=250, min_border_left=50, min
             """
         )
 
-    color_mapper = LinearColorMapper(palette="Viridis256", low=mjd_int.min(), high=mjd_int.max())
+    fig.add_tools(hover_obs)
 
-    #making figure
-    fig = bk.figure(width=width, height=height, min_border_left=min_border_left, min_border_right=min_border_right)
+    return fig
 
-    #unobserved tiles
-    fig.circle('RA', 'DEC', source=source, color='gray', radius=0.25)
+def get_nightly_stats(exposures, attributes=('AIRMASS', 'SEEING', 'EXPTIME', 'TRANSP', 'SKY'), programs=('BRIGHT', 'GRAY', 'DARK', 'CALIB')):
+    '''
+    Computes per-night exposure counts and medians for all nights at once,
+    grouping the exposures by night with a single sort instead of scanning
+    the table once per night.
 
-    #observed tiles
-    fig.circle('RA_obs', 'DEC_obs', color=transform('MJD', color_mapper), size=3, alpha=0.85, source=source_obs)
-    color_bar = ColorBar(color_mapper=color_mapper, label_standoff=12, location=(0,0), title='MJD', width=5)
-    fig.add_layout(color_bar, 'right')
+    Args:
+        exposures: Table of exposures with columns NIGHT, PROGRAM and the attributes
 
-    fig.xaxis.axis_label = 'RA [degrees]'
-    fig.yaxis.axis_label = 'Declination [degrees]'
-    fig.title.text = 'Observed Tiles, Nightly Progress'
+    Options:
+        attributes: column names to compute nightly medians of, ignoring masked values
+        programs: PROGRAM names to count exposures of
+
+    Returns dict of arrays with one entry per night, keyed by
+        "NIGHT": sorted unique nights (strings)
+        "TOTAL": number of exposures
+        each program: number of exposures of that program
+        each attribute: median value, or NaN if all values are masked
+    '''
+    nights, inverse = np.unique(np.asarray(exposures['NIGHT']).astype(str), return_inverse=True)
+    num_nights = len(nights)
+    stats = dict(NIGHT=nights, TOTAL=np.bincount(inverse, minlength=num_nights))
+
+    #- Counts per (night, program) pair from one bincount
+    progs, prog_inverse = np.unique(np.asarray(exposures['PROGRAM']).astype(str), return_inverse=True)
+    counts = np.bincount(inverse*len(progs) + prog_inverse, minlength=num_nights*len(progs))
+    counts = counts.reshape(num_nights, len(progs))
+    for program in programs:
+        if program in progs:
+            stats[program] = counts[:, np.searchsorted(progs, program)]
+        else:
+            stats[program] = np.zeros(num_nights, dtype=int)
+
+    #- Medians: sort unmasked values by (night, value) and take the middle of each night
+    for attribute in attributes:
+        column = exposures[attribute]
+        valid = ~np.ma.getmaskarray(column)
+        values = np.ma.getdata(column)[valid].astype(float)
+        night_id = inverse[valid]
+
+        values = values[np.lexsort((values, night_id))]
+        n = np.bincount(night_id, minlength=num_nights)
+        start = np.cumsum(n) - n
+        observed = (n > 0)
+
+        medians = np.full(num_nights, np.nan)
+        lo = (start + (n-1)//2)[observed]
+        hi = (start + n//2)[observed]
+        medians[observed] = 0.5*(values[lo] + values[hi])
+        stats[attribute] = medians
+
+    return stats
+
+def update_nightly_stats(nightly_stats, exposures):
+    '''
+    Replaces the nightly aggregates of the nights of EXPOSURES, e.g. after
+    exposures of those nights were appended, keeping those of other nights
 
-    fig.add_tools(hover)
+    Args:
+        nightly_stats: per-night aggregates from get_nightly_stats
+        exposures: Table of all exposures of the nights to update
 
-    return fig
+    Returns dict of arrays like get_nightly_stats, sorted by night
+    '''
+    new_stats = get_nightly_stats(exposures)
+    keep = ~np.isin(nightly_stats['NIGHT'], new_stats['NIGHT'])
+    stats = {key: np.concatenate([nightly_stats[key][keep], new_stats[key]]) for key in nightly_stats}
+    order = np.argsort(stats['NIGHT'], kind='stable')
+    return {key: value[order] for key, value in stats.items()}
 
 def get_median(attribute, exposures):
     '''Get the median value for a given attribute for all nights for all exposures taken each night.
@@ -139,68 +382,49 @@ def get_median(attribute, exposures):
         attributes: one of the labels in the exposure column, string
         exposures: table with the exposures data
     Output:
-        returns a numpy array of the median values for each night
+        returns a numpy array of the median values for each night (masked values are ignored)
     '''
-    medians = []
-    for n in np.unique(exposures['NIGHT']):
-        ii = (exposures['NIGHT'] == n)
-        attrib = np.asarray(exposures[attribute])[ii]
-        medians.append(np.ma.median(attrib))  #- use masked median
-
-    return np.array(medians)
+    return get_nightly_stats(exposures, attributes=[attribute], programs=[])[attribute]
 
-def get_summarytable(exposures):
+def get_summarytable(exposures, nightly_stats=None, single_page=False):
     '''
-    Generates a summary table of key values for each night observed. Uses collections.Counter(), OrderedDict()
+    Generates a summary table of key values for each night observed. Uses get_nightly_stats()
 
     Args:
         exposures: Table of exposures with columns...
 
+    Options:
+        nightly_stats: per-night aggregates of exposures from
+            get_nightly_stats; computed if not given
+        single_page: if True, link the nights to the single page dashboard
+            (dashboard.html#YEARMMDD) instead of the night-*.html pages
+
     Returns a bokeh DataTable object.
     '''
-    nights = np.unique(exposures['NIGHT'])
-
-    isbright = (exposures['PROGRAM'] == 'BRIGHT')
-    isgray = (exposures['PROGRAM'] == 'GRAY')
-    isdark = (exposures['PROGRAM'] == 'DARK')
-    iscalib = (exposures['PROGRAM'] == 'CALIB')
-
-    num_nights = len(nights)
-    brights = list()
-    grays = list()
-    darks = list()
-    calibs = list()
-    totals = list()
-    for n in nights:
-        thisnight = exposures['NIGHT'] == n
-        totals.append(np.count_nonzero(thisnight))
-        brights.append(np.count_nonzero(thisnight & isbright))
-        grays.append(np.count_nonzero(thisnight & isgray))
-        darks.append(np.count_nonzero(thisnight & isdark))
-        calibs.append(np.count_nonzero(thisnight & iscalib))
-
-    med_air = get_median('AIRMASS', exposures)
-    med_seeing = get_median('SEEING', exposures)
-    med_exptime = get_median('EXPTIME', exposures)
-    med_transp = get_median('TRANSP', exposures)
-    med_sky = get_median('SKY', exposures)
+    if nightly_stats is None:
+        nightly_stats = get_nightly_stats(exposures)
+    stats = nightly_stats
 
     source = ColumnDataSource(data=dict(
-        nights = list(nights),
-        totals = totals,
-        brights = brights,
-        grays = grays,
-        darks = darks,
-        calibs = calibs,
-        med_air = med_air,
-        med_seeing = med_seeing,
-        med_exptime = med_exptime,
-        med_transp = med_transp,
-        med_sky = med_sky,
+        nights = list(stats['NIGHT']),
+        totals = stats['TOTAL'],
+        brights = stats['BRIGHT'],
+        grays = stats['GRAY'],
+        darks = stats['DARK'],
+        calibs = stats['CALIB'],
+        med_air = stats['AIRMASS'],
+        med_seeing = stats['SEEING'],
+        med_exptime = stats['EXPTIME'],
+        med_transp = stats['TRANSP'],
+        med_sky = stats['SKY'],
     ))
 
     formatter = NumberFormatter(format='0,0.00')
-    template_str = '<a href="night-<%= nights %>.html"' + ' target="_blank"><%= value%></a>'
+    if single_page:
+        href = 'dashboard.html#<%= nights %>'
+    else:
+        href = 'night-<%= nights %>.html'
+    template_str = '<a href="' + href + '"' + ' target="_blank"><%= value%></a>'
 
     columns = [
         TableColumn(field='nights', title='NIGHT', width=100, formatter=HTMLTemplateFormatter(template=template_str)),
@@ -219,7 +443,7 @@ def get_summarytable(exposures):
     summary_table = DataTable(source=source, columns=columns, width=900, sortable=True, fit_columns=False)
     return summary_table
 
-def nights_last_observed(exposures):
+def nights_last_observed(exposures, tile_stats=None):
     '''
     Generates a table of the last exposure for every unique TILEID.
     Mainly serves as a helper function for get_surveyprogress()
@@ -227,18 +451,51 @@ def nights_last_observed(exposures):
     Args:
         exposures: Table of exposures
 
-    Returns Table object
+    Options:
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
+
+    Returns Table object of the last science exposure of each tile, sorted
+    by TILEID
     '''
-    def last(arr):
-        return arr[len(arr)-1]
-    return exposures.group_by("TILEID").groups.aggregate(last)
+    if tile_stats is None:
+        tile_stats = get_tile_stats(exposures)
+    return exposures[tile_stats['LAST_ROW']]
 
 utc_offset = -7*u.hour
-tzone = TimezoneInfo(utc_offset = utc_offset)
-t1 = Time(58821, format='mjd', scale='utc')
-t = t1.to_datetime(timezone=tzone)
+with offline_iers():
+    t = (Time(58821, format='mjd', scale='utc') + utc_offset).datetime64
+
+#- Nominal length of the survey for the dashed reference lines
+survey_length = np.timedelta64(int(round(365.2422*5*86400e3)), 'ms')
+
+#- Hover label of the progress plots, formatted client-side from the x values
+progress_date_format = '@x{%a, %d %b %Y %H:%M}'
+
+#- HoverTool formatters are keyed by the field with its '@' since bokeh 2
+progress_date_formatters = {'x' if int(bokeh.__version__.split('.')[0]) < 2 else '@x': 'datetime'}
+
+def get_night_steps(mjd):
+    '''
+    Returns the indices of the first and last entry of each night
+
+    Args:
+        mjd: sorted array of UTC MJDs
+
+    Returns sorted array of indices into mjd, with one entry for the nights
+    with a single MJD and two entries for the other nights (empty if mjd is
+    empty). Nights change at local noon.
+    '''
+    if len(mjd) == 0:
+        return np.zeros(0, dtype=int)
+
+    night = np.floor(np.asarray(mjd) + utc_offset.to_value(u.day) - 0.5)
+    newnight = np.flatnonzero(night[1:] != night[:-1]) + 1
+    first = np.concatenate([[0], newnight])
+    last = np.concatenate([newnight - 1, [len(night) - 1]])
+    return np.unique(np.concatenate([first, last]))
 
-def get_progress(exposures, tiles, program):
+def get_progress(exposures, tiles, program, full_resolution=False, tile_stats=None, tile_index=None):
     '''Get survey and tile progress for a given program
 
     Args:
@@ -246,34 +503,60 @@ def get_progress(exposures, tiles, program):
         tiles: Table with columns TILEID, EXPOSEFAC
         program: str program name to filter
 
+    Options:
+        full_resolution: if True, return one point per finished tile instead
+            of only the first and last finished tile of each night
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
+        tile_index: index of tiles from get_tile_index; computed if not given
+
     Returns (time, survey_progress, tile_progress)
 
-    time = array of datetime objects;
+    time = numpy datetime64 array of local times;
     survey_progress = array of EXPOSEFAC-weighted progress on observing tiles;
     tile_progress = array of number of tiles observed
     '''
-
-    keep = exposures['PROGRAM'] == program
-    exposures = exposures['TILEID', 'MJD'][keep]
-    keep = tiles['PROGRAM'] == program
-    tiles = tiles['TILEID', 'EXPOSEFAC'][keep]
-
-    #- Create table of last exposure for each tile, sorted by MJD
-    finished_tiles = exposures.group_by('TILEID').groups.aggregate(np.max)
-    finished_tiles = join(finished_tiles, tiles, keys='TILEID', join_type='left')
-    finished_tiles.sort('MJD')
-
-    #- Convert MJD to list of datetimes for bokeh
-    t1 = Time(finished_tiles['MJD'], format='mjd', scale='utc')
-    # t = t1.to_datetime(timezone=tzone)
-    # local non-timezone aware time, instead of much slower timezone aware
-    t = (t1 + utc_offset).to_datetime()
+    if tile_stats is None:
+        tile_stats = get_tile_stats(exposures)
+
+    #- Last exposure of each tile of the program, sorted by MJD
+    keep = tile_stats['PROGRAM'] == program
+    mjd = tile_stats['LAST_MJD'][keep]
+    finished = tile_stats['TILEID'][keep]
+    order = np.argsort(mjd, kind='stable')
+    mjd = mjd[order]
+    finished = finished[order]
+
+    #- EXPOSEFAC of the finished tiles, from the tiles of the program
+    in_program = np.asarray(tiles['PROGRAM'] == program)
+    if tile_index is None:
+        tile_index = get_tile_index(tiles)
+    tile_order, tileid = tile_index
+    pos = np.searchsorted(tileid, finished).clip(0, max(len(tileid)-1, 0))
+    exposefac = np.asarray(tiles['EXPOSEFAC'], dtype=float)[tile_order][pos]
+    match = (tileid[pos] == finished) & in_program[tile_order][pos]
+    exposefac[~match] = 0.0
 
     #- Tile progress is just counting tiles
-    tile_progress = np.arange(len(t))
+    tile_progress = np.arange(len(mjd))
 
     #- Survey progress is weighted by EXPOSEFAC
-    survey_progress = np.cumsum(finished_tiles['EXPOSEFAC']) / np.sum(tiles['EXPOSEFAC'])
+    survey_progress = np.cumsum(exposefac) / np.sum(np.asarray(tiles['EXPOSEFAC'], dtype=float)[in_program])
+
+    #- The curves are a few hundred pixels wide, so by default only keep the
+    #- progress at the start and end of each night, which is exact there
+    #- and bounds the size of the plots by the number of nights
+    if not full_resolution:
+        steps = get_night_steps(mjd)
+        mjd = mjd[steps]
+        tile_progress = tile_progress[steps]
+        survey_progress = survey_progress[steps]
+
+    #- Convert MJD to local datetime64, which bokeh serializes as a binary
+    #- array of epoch milliseconds without any per-point Python objects
+    with offline_iers():
+        t1 = Time(mjd, format='mjd', scale='utc')
+        t = (t1 + utc_offset).datetime64
 
     return t, tile_progress, survey_progress
 
@@ -300,9 +583,10 @@ def get_surveyprogress_plot(progress, line_source, hover_follow, width=250, heig
     hover = HoverTool(
             names=["D", "G", "B"],
             tooltips=[
-                ("DATE", "@date"),
+                ("DATE", progress_date_format),
                 ("TOTAL PERCENTAGE", "@y")
-            ]
+            ],
+            formatters=progress_date_formatters,
         )
 
     fig1 = bk.figure(plot_width=width, plot_height=height, title = "Survey progress", x_axis_label = "Time", y_axis_label = "Fraction", x_axis_type="datetime", min_border_left=min_border_left, min_border_right=min_border_right)
@@ -315,31 +599,28 @@ def get_surveyprogress_plot(progress, line_source, hover_follow, width=250, heig
             data=dict(
                 x=x_d,
                 y=y_d,
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in x_d],
             )
         )
     source_g = ColumnDataSource(
             data=dict(
                 x=x_g,
                 y=y_g,
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in x_g],
             )
         )
     source_b = ColumnDataSource(
             data=dict(
                 x=x_b,
                 y=y_b,
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in x_b],
             )
         )
 
-    tstart = min(x_d[0], x_g[0], x_b[0])
-    tend = tstart + timedelta(365.2422*5)
+    #- Programs without any finished tile have empty curves
+    tstart = np.min(np.concatenate([x_d[0:1], x_g[0:1], x_b[0:1]]))
+    tend = tstart + survey_length
     source_line = ColumnDataSource(
             data=dict(
                 x=[tstart, tend],
                 y=[0, 1],
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in [tstart, tend]],
             )
         )
 
@@ -383,9 +664,10 @@ def get_tileprogress_plot(progress, tiles, line_source, hover_follow, width=250,
     hover = HoverTool(
             names=["G", "D", "B"],
             tooltips=[
-                ("DATE", "@date"),
+                ("DATE", progress_date_format),
                 ("# tiles", "@y")
-            ]
+            ],
+            formatters=progress_date_formatters,
         )
 
     fig = bk.figure(plot_width=width, plot_height=height, title = "# tiles vs time", x_axis_label = "Time",
@@ -399,32 +681,29 @@ def get_tileprogress_plot(progress, tiles, line_source, hover_follow, width=250,
             data=dict(
                 x=x_d,
                 y=y_d,
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in x_d],
             )
         )
     source_g = ColumnDataSource(
             data=dict(
                 x=x_g,
                 y=y_g,
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in x_g],
             )
         )
     source_b = ColumnDataSource(
             data=dict(
                 x=x_b,
                 y=y_b,
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in x_b],
             )
         )
 
-    tstart = min(x_d[0], x_g[0], x_b[0])
-    tend = tstart + timedelta(365.2422*5)
+    #- Programs without any finished tile have empty curves
+    tstart = np.min(np.concatenate([x_d[0:1], x_g[0:1], x_b[0:1]]))
+    tend = tstart + survey_length
     t = [tstart, tend]
     source_line_d = ColumnDataSource(
             data=dict(
                 x=t,
                 y=[0, len(tiles[tiles["PROGRAM"] == "DARK"])],
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in t],
             )
         )
 
@@ -432,7 +711,6 @@ def get_tileprogress_plot(progress, tiles, line_source, hover_follow, width=250,
             data=dict(
                 x=t,
                 y=[0, len(tiles[tiles["PROGRAM"] == "GRAY"])],
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in t],
             )
         )
 
@@ -440,7 +718,6 @@ def get_tileprogress_plot(progress, tiles, line_source, hover_follow, width=250,
             data=dict(
                 x=t,
                 y=[0, len(tiles[tiles["PROGRAM"] == "BRIGHT"])],
-                date=[t1.strftime("%a, %d %b %Y %H:%M") for t1 in t],
             )
         )
 
@@ -465,7 +742,8 @@ def get_tileprogress_plot(progress, tiles, line_source, hover_follow, width=250,
     fig.add_tools(hover_follow)
     return fig
 
-def get_linked_progress_plots(exposures, tiles, width=300, height=300, min_border_left=50, min_border_right=50):
+def get_linked_progress_plots(exposures, tiles, width=300, height=300, min_border_left=50, min_border_right=50, full_resolution=False, tile_stats=None,
+                              tile_index=None):
     '''
     Generates linked progress plots of frac(EXPOSEFAC) vs. time, and (total # of tiles) vs. time
 
@@ -476,6 +754,11 @@ def get_linked_progress_plots(exposures, tiles, width=300, height=300, min_borde
     Options:
         width, height: plot width and height in pixels
         min_border_left, min_border_right: set minimum width for external labels in pixels
+        full_resolution: plot every finished tile instead of the start and
+            end of each night (see get_progress)
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
+        tile_index: index of tiles from get_tile_index; computed if not given
 
     Returns bokeh Layout object
     '''
@@ -483,8 +766,8 @@ def get_linked_progress_plots(exposures, tiles, width=300, height=300, min_borde
     # Data Source for the curser-following vertical line on the progress plots
     first_expose = np.min(exposures['MJD'])
     startend = np.array([first_expose, first_expose + 365.2422*5])
-    startend_t = Time(startend, format='mjd', scale='utc')
-    startend_t = startend_t.to_datetime(timezone=tzone)
+    with offline_iers():
+        startend_t = (Time(startend, format='mjd', scale='utc') + utc_offset).datetime64
 
     line_source = ColumnDataSource(data=dict(x=[t], lower=[startend_t[0]], upper=[startend_t[1]]))
 
@@ -508,9 +791,15 @@ def get_linked_progress_plots(exposures, tiles, width=300, height=300, min_borde
                           point_policy='follow_mouse',
                           callback=CustomJS(code=js, args={'line_source': line_source}))
 
+    if tile_stats is None:
+        tile_stats = get_tile_stats(exposures)
+    if tile_index is None:
+        tile_index = get_tile_index(tiles)
+
     progress = dict()
     for program in ['DARK', 'GRAY', 'BRIGHT']:
-        progress[program] = get_progress(exposures, tiles, program)
+        progress[program] = get_progress(exposures, tiles, program, full_resolution=full_resolution,
+                                         tile_stats=tile_stats, tile_index=tile_index)
 
     surveyprogress = get_surveyprogress_plot(progress, line_source, hover_follow, width=width, height=height, min_border_left=min_border_left, min_border_right=min_border_right)
     tileprogress = get_tileprogress_plot(progress, tiles, line_source, hover_follow, width=width, height=height, min_border_left=min_border_left, min_border_right=min_border_right)
@@ -554,7 +843,7 @@ def get_hist(exposures, attribute, color, width=250, height=250, min_border_left
 
     return fig_0
 
-def get_exposuresPerTile_hist(exposures, color, width=250, height=250, min_border_left=50, min_border_right=50):
+def get_exposuresPerTile_hist(exposures, color, width=250, height=250, min_border_left=50, min_border_right=50, tile_stats=None):
     '''
     Generates a histogram of the number of exposures per tile for the given
     exposures table
@@ -566,19 +855,16 @@ def get_exposuresPerTile_hist(exposures, color, width=250, height=250, min_borde
     Options:
         width, height: plot width and height in pixels
         min_border_left, min_border_right: set minimum width for external labels in pixels
-        min_border_left, min_border_right: set minimum width for external labels in pixels
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
 
     Returns bokeh Figure object
     '''
-    keep = exposures['PROGRAM'] != 'CALIB'
-    exposures_nocalib = exposures[keep]
+    if tile_stats is None:
+        tile_stats = get_tile_stats(exposures)
 
-    exposures_nocalib["ones"] = 1
-    exposures_nocalib = exposures_nocalib["ones", "TILEID"]
-    exposures_nocalib = exposures_nocalib.group_by("TILEID")
-    exposures_nocalib = exposures_nocalib.groups.aggregate(np.sum)
-
-    hist, edges = np.histogram(exposures_nocalib["ones"], density=True, bins=np.arange(0, np.max(exposures_nocalib["ones"])+1))
+    nexp = tile_stats['NEXP']
+    hist, edges = np.histogram(nexp, density=True, bins=np.arange(0, np.max(nexp)+1))
 
     fig_3 = bk.figure(plot_width=width, plot_height=height,
                     x_axis_label = "# Exposures per Tile",
@@ -676,7 +962,7 @@ def get_moonplot(exposures, width=250, height=250, min_border_left=50, min_borde
     p.circle("MOONFRAC", "MOONALT", color=transform('MOONSEP', color_mapper), alpha=0.5, source=source)
     return p
 
-def get_expTimePerTile(exposures, width=250, height=250, min_border_left=50, min_border_right=50):
+def get_expTimePerTile(exposures, width=250, height=250, min_border_left=50, min_border_right=50, tile_stats=None):
     '''
     Generates three overlaid histogram of the total exposure time per tile for the given
     exposures table. Each of the histograms correspond to different
@@ -688,12 +974,13 @@ def get_expTimePerTile(exposures, width=250, height=250, min_border_left=50, min
     Options:
         width, height: plot width and height in pixels
         min_border_left, min_border_right: set minimum width for external labels in pixels
+        tile_stats: per-tile aggregates of exposures from get_tile_stats;
+            computed if not given
 
     Returns bokeh Figure object
     '''
-    keep = exposures['PROGRAM'] != 'CALIB'
-    exposures_nocalib = exposures[keep]
-    exposures_nocalib = exposures_nocalib["PROGRAM", "TILEID", "EXPTIME"]
+    if tile_stats is None:
+        tile_stats = get_tile_stats(exposures)
 
     fig = bk.figure(plot_width=width, plot_height=height, title = 'title', x_axis_label = "Total Exposure Time (Minutes)", min_border_left=min_border_left, min_border_right=min_border_right)
     fig.yaxis.major_label_text_font_size = '0pt'
@@ -708,12 +995,11 @@ def get_expTimePerTile(exposures, width=250, height=250, min_border_left=50, min
             program: String of the desired program name
             color: Color of histogram
         '''
-        thisprogram = (exposures_nocalib["PROGRAM"] == program)
+        thisprogram = (tile_stats["PROGRAM"] == program)
         if not any(thisprogram):
             return
 
-        a = exposures_nocalib["TILEID", "EXPTIME"][thisprogram].group_by("TILEID").groups.aggregate(np.sum)
-        hist, edges = np.histogram(np.array(a["EXPTIME"])/60, density=True, bins=50)
+        hist, edges = np.histogram(tile_stats["EXPTIME"][thisprogram]/60, density=True, bins=50)
         fig.quad(top=hist, bottom=0, left=edges[:-1], right=edges[1:], fill_color=color, alpha=0.5, legend = program)
 
     total_exptime_dgb("DARK", "red")
@@ -729,200 +1015,143 @@ def get_expTimePerTile(exposures, width=250, height=250, min_border_left=50, min
 
     return fig
 
-def makeplots(exposures, tiles, outdir):
+#- Names of the figures on the summary page; the HTML template has
+#- NAME_script and NAME_div placeholders for each of them
+summary_figures = ['skyplot', 'progress', 'summarytable', 'airmass', 'seeing',
+                   'transp_hist', 'exposePerTile_hist', 'brightness', 'hourangle',
+                   'exptime', 'expTimePerTile', 'moonplot']
+
+def get_summary_figure(name, exposures, tiles, min_border=30, full_progress=False, raster_sky=False, tile_stats=None, nightly_stats=None,
+                       single_page=False, tile_index=None):
     '''
-    Generates summary plots for the DESI survey QA
+    Generates one of the figures of the summary page
 
     Args:
+        name: one of summary_figures
         exposures: Table of exposures with columns ...
         tiles: Table of tile locations with columns ...
-        outdir: directory to write the files
 
-    Writes outdir/summary.html
+    Options:
+        min_border: minimum width for external labels in pixels
+        full_progress: plot the progress of every finished tile instead of
+            per-night steps (see get_progress)
+        raster_sky: show the tiles of the sky plot as images (see get_skyplot)
+        tile_stats: per-tile aggregates of exposures from get_tile_stats,
+            shared by the figures of tiles; computed if needed and not given
+        tile_index: index of tiles from get_tile_index, shared by the figures
+            of tiles; computed if needed and not given
+        nightly_stats: per-night aggregates of exposures from
+            get_nightly_stats for the summary table; computed if not given
+        single_page: link the nights of the summary table to the single page
+            dashboard (see get_summarytable)
+
+    Returns bokeh Figure, Layout or DataTable object
+    '''
+    if name == 'skyplot':
+        return get_skyplot(exposures, tiles, 500, 250, min_border_left=min_border, min_border_right=min_border, rasterize=raster_sky, tile_stats=tile_stats, tile_index=tile_index)
+    elif name == 'progress':
+        return get_linked_progress_plots(exposures, tiles, 250, 250, min_border_left=min_border, min_border_right=min_border, full_resolution=full_progress, tile_stats=tile_stats, tile_index=tile_index)
+    elif name == 'summarytable':
+        return get_summarytable(exposures, nightly_stats=nightly_stats, single_page=single_page)
+    elif name == 'seeing':
+        return get_hist(exposures, "SEEING", "navy", 250, 250, min_border_left=min_border, min_border_right=min_border)
+    elif name == 'airmass':
+        return get_hist(exposures, "AIRMASS", "green", 250, 250, min_border_left=min_border, min_border_right=min_border)
+    elif name == 'transp_hist':
+        return get_hist(exposures, "TRANSP", "purple", 250, 250, min_border_left=min_border, min_border_right=min_border)
+    elif name == 'exposePerTile_hist':
+        return get_exposuresPerTile_hist(exposures, "orange", 250, 250, min_border_left=min_border, min_border_right=min_border, tile_stats=tile_stats)
+    elif name == 'exptime':
+        return get_exposeTimes_hist(exposures, 250, 250, min_border_left=min_border, min_border_right=min_border)
+    elif name == 'moonplot':
+        return get_moonplot(exposures, 500, 250, min_border_left=min_border, min_border_right=min_border)
+    elif name == 'brightness':
+        return get_hist(exposures, "SKY", "maroon", 250, 250, min_border_left=min_border, min_border_right=min_border)
+    elif name == 'hourangle':
+        return get_hist(exposures, "HOURANGLE", "magenta", 250, 250, min_border_left=min_border, min_border_right=min_border)
+    elif name == 'expTimePerTile':
+        return get_expTimePerTile(exposures, 250, 250, min_border_left=min_border, min_border_right=min_border, tile_stats=tile_stats)
+    else:
+        raise ValueError('Unknown summary figure {}'.format(name))
+
+def get_summary_components(name, exposures, tiles, full_progress=False, raster_sky=False, tile_stats=None, nightly_stats=None,
+                           single_page=False, tile_index=None):
     '''
+    Generates the HTML components of one of the figures of the summary page,
+    so that the figures can be built independently (e.g. in parallel)
 
-    #- Generate HTML header separately so that we can get the right bokeh
-    #- version in there without mucking up the python string formatting
-    header = """
-    <!DOCTYPE html>
-    <html lang="en-US">
-
-    <link
-        href="https://cdn.pydata.org/bokeh/release/bokeh-{version}.min.css"
-        rel="stylesheet" type="text/css"
-    >
-    <link
-        href="https://cdn.pydata.org/bokeh/release/bokeh-tables-{version}.min.css"
-        rel="stylesheet" type="text/css"
-    >
-    <script
-        src="https://cdn.pydata.org/bokeh/release/bokeh-{version}.min.js"
-    ></script>
-
-    <script src="https://cdn.pydata.org/bokeh/release/bokeh-tables-{version}.min.js"
-    ></script>
-
-    <script type="text/javascript">
-    if (typeof Bokeh == 'undefined')
-    {{
-        document.write("<link href='offline_files/bokeh-{version}.css' rel='stylesheet' type='text/css'>");
-        document.write("<link href='offline_files/bokeh_tables-{version}.css' rel='stylesheet' type='text/css'>");
-        document.write("<script src='offline_files/bokeh-{version}.js' type='text/javascript'><\/script>");
-        document.write("<script src='offline_files/bokeh_tables-{version}.js' type='text/javascript'><\/script>");
-    }}
-    </script>
-
-    """.format(version=bokeh.__version__)
-
-    #- CSS styling
-    template = header + """
-    <head>
-    <style>
-    body {
-        margin: 0;
-    }
+    Args:
+        name: one of summary_figures
+        exposures: Table of exposures with columns ...
+        tiles: Table of tile locations with columns ...
 
-    .header {
-        font-family: "Open Serif", Arial, Helvetica, sans-serif;
-        background-color: #f1f1f1;
-        padding: 10px;
-        text-align: left;
-        justify: space-around;
-    }
+    Options:
+        full_progress, raster_sky, tile_stats, nightly_stats, single_page,
+            tile_index: see get_summary_figure
 
-    .column {
-        float: center;
-    }
+    Returns (script, div) from bokeh.embed.components
+    '''
+    with stage('summary.'+name, 'summary'):
+        fig = get_summary_figure(name, exposures, tiles, full_progress=full_progress,
+            raster_sky=raster_sky, tile_stats=tile_stats, nightly_stats=nightly_stats,
+            single_page=single_page, tile_index=tile_index)
+    with stage('components', 'summary'):
+        return components(fig)
+
+def write_summary_html(outdir, lastnight, parts):
+    '''
+    Assembles the summary page from the components of its figures
 
-    .column.side {
-        width = 10%;
-    }
+    Args:
+        outdir: directory to write the files
+        lastnight: last night (string) included in the summary
+        parts: dict of (script, div) keyed by the names in summary_figures
 
-    .column.middle {
-        width = 80%;
-    }
+    Writes outdir/summary.html
+    '''
 
-    .flex-container {
-        display: flex;
-        flex-direction: row;
-        flex-flow: row wrap;
-        justify-content: flex-start;
-        padding: 10px;
-        align-items: flex-end;
-    }
+    #- Render the HTML from the summary page template
+    values = dict(lastnight=lastnight)
+    for name in summary_figures:
+        values[name+'_script'], values[name+'_div'] = parts[name]
 
-    p.sansserif {
-        font-family: "Open Serif", Helvetica, sans-serif;
-    }
-    </style>
-    </head>
-    """
-
-    #- Now add the HTML body with template placeholders for plots
-    template += """
-    <body>
-        <div class="flex-container">
-            <div class="column side"></div>
-            <div class="column middle">
-                <div class="header">
-                    <p class='sansserif'>DESI Survey QA through {}</p>
-        </div>
-    """.format(max(exposures['NIGHT']))
-
-    template += """
-                <div class="flex-container">
-                    <div>{{ skyplot_script }} {{ skyplot_div }}</div>
-                    <div>{{ progress_script }} {{ progress_div }}</div>
-                </div>
-
-                <div class="header">
-                    <p class="sansserif">Observing Conditions</p>
-                </div>
-
-                <div class="flex-container">
-                    <div>{{ airmass_script }} {{ airmass_div }}</div>
-                    <div>{{ seeing_script }} {{ seeing_div }}</div>
-                    <div>{{ transp_hist_script }} {{ transp_hist_div }}</div>
-                    <div>{{ exposePerTile_hist_script }} {{ exposePerTile_hist_div }}</div>
-                    <div>{{ brightness_script }} {{ brightness_div }}</div>
-                    <div>{{ hourangle_script }} {{ hourangle_div }}</div>
-                    <div>{{ exptime_script }} {{ exptime_div }}</div>
-                    <div>{{ expTimePerTile_script }} {{ expTimePerTile_div }}</div>
-                    <div>{{ moonplot_script }} {{ moonplot_div }}</div>
-                </div>
-
-                <div class="header">
-                    <p class="sansserif">Summary Table</p>
-                </div>
-
-                <div class="flex-container">
-                    {{ summarytable_script }}
-                    {{ summarytable_div }}
-                </div>
-            </div>
-            <div class="column side"></div>
-        </div>
-    </body>
-
-    </html>
-    """
-
-    min_border = 30
-
-    skyplot = get_skyplot(exposures, tiles, 500, 250, min_border_left=min_border, min_border_right=min_border)
-    skyplot_script, skyplot_div = components(skyplot)
-
-    progressplot = get_linked_progress_plots(exposures, tiles, 250, 250, min_border_left=min_border, min_border_right=min_border)
-    progress_script, progress_div = components(progressplot)
-
-    summarytable = get_summarytable(exposures)
-    summarytable_script, summarytable_div = components(summarytable)
-
-    seeing_hist = get_hist(exposures, "SEEING", "navy", 250, 250, min_border_left=min_border, min_border_right=min_border)
-    seeing_script, seeing_div = components(seeing_hist)
-
-    airmass_hist = get_hist(exposures, "AIRMASS", "green", 250, 250, min_border_left=min_border, min_border_right=min_border)
-    airmass_script, airmass_div = components(airmass_hist)
-
-    transp_hist = get_hist(exposures, "TRANSP", "purple", 250, 250, min_border_left=min_border, min_border_right=min_border)
-    transp_hist_script, transp_hist_div = components(transp_hist)
-
-    exposePerTile_hist = get_exposuresPerTile_hist(exposures, "orange", 250, 250, min_border_left=min_border, min_border_right=min_border)
-    exposePerTile_hist_script, exposePerTile_hist_div = components(exposePerTile_hist)
-
-    exptime_hist = get_exposeTimes_hist(exposures, 250, 250, min_border_left=min_border, min_border_right=min_border)
-    exptime_script, exptime_div = components(exptime_hist)
-
-    moonplot = get_moonplot(exposures, 500, 250, min_border_left=min_border, min_border_right=min_border)
-    moonplot_script, moonplot_div = components(moonplot)
-
-    brightnessplot = get_hist(exposures, "SKY", "maroon", 250, 250, min_border_left=min_border, min_border_right=min_border)
-    brightness_script, brightness_div = components(brightnessplot)
-
-    hourangleplot = get_hist(exposures, "HOURANGLE", "magenta", 250, 250, min_border_left=min_border, min_border_right=min_border)
-    hourangle_script, hourangle_div = components(hourangleplot)
-
-    expTimePerTile_plot = get_expTimePerTile(exposures, 250, 250, min_border_left=min_border, min_border_right=min_border)
-    expTimePerTile_script, expTimePerTile_div = components(expTimePerTile_plot)
-
-    #- Convert to a jinja2.Template object and render HTML
-    html = jinja2.Template(template).render(
-        skyplot_script=skyplot_script, skyplot_div=skyplot_div,
-        progress_script=progress_script, progress_div=progress_div,
-        summarytable_script=summarytable_script, summarytable_div=summarytable_div,
-        airmass_script=airmass_script, airmass_div=airmass_div,
-        seeing_script=seeing_script, seeing_div=seeing_div,
-        exptime_script=exptime_script, exptime_div=exptime_div,
-        transp_hist_script=transp_hist_script, transp_hist_div=transp_hist_div,
-        exposePerTile_hist_script=exposePerTile_hist_script, exposePerTile_hist_div=exposePerTile_hist_div,
-        brightness_script=brightness_script, brightness_div=brightness_div,
-        hourangle_script=hourangle_script, hourangle_div=hourangle_div,
-        expTimePerTile_script=expTimePerTile_script, expTimePerTile_div=expTimePerTile_div,
-        moonplot_script=moonplot_script, moonplot_div=moonplot_div,
-        )
+    with stage('render', 'summary'):
+        html = surveyqa.render.render('summary.html', **values)
 
     outfile = os.path.join(outdir, 'summary.html')
-    with open(outfile, 'w') as fx:
-        fx.write(html)
+    with stage('write', 'summary'):
+        with open(outfile, 'w') as fx:
+            fx.write(html)
 
     print('Wrote summary QA to {}'.format(outfile))
+
+def makeplots(exposures, tiles, outdir, full_progress=False, raster_sky=False, tile_stats=None, nightly_stats=None,
+              single_page=False):
+    '''
+    Generates summary plots for the DESI survey QA
+
+    Args:
+        exposures: Table of exposures with columns ...
+        tiles: Table of tile locations with columns ...
+        outdir: directory to write the files
+
+    Options:
+        full_progress, raster_sky, single_page: see get_summary_figure
+        tile_stats, nightly_stats: aggregates of exposures, e.g. persisted by
+            surveyqa.cache.append_exposures; computed if not given
+
+    Writes outdir/summary.html
+    '''
+    if tile_stats is None:
+        with stage('get_tile_stats', 'summary'):
+            tile_stats = get_tile_stats(exposures)
+    tile_index = get_tile_index(tiles)
+
+    parts = dict()
+    for name in summary_figures:
+        parts[name] = get_summary_components(name, exposures, tiles,
+            full_progress=full_progress, raster_sky=raster_sky,
+            tile_stats=tile_stats, nightly_stats=nightly_stats, single_page=single_page,
+            tile_index=tile_index)
+
+    write_summary_html(outdir, max(exposures['NIGHT']), parts)
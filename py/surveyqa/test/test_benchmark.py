@@ -0,0 +1,53 @@
+"""
+Tests of surveyqa.benchmark
+"""
+
+import os
+import tempfile, shutil
+import unittest
+
+import numpy as np
+
+import surveyqa.benchmark
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='surveyqa-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def test_make_exposures(self):
+        '''synthetic exposures start each night with calibrations and observe the synthetic tiles'''
+        tiles = surveyqa.benchmark.make_tiles(ntiles=200)
+        self.assertEqual(len(tiles), 200)
+        self.assertTrue(np.all(tiles['IN_DESI'] == 1))
+
+        exposures = surveyqa.benchmark.make_exposures(tiles, 0.02)
+        nights = np.unique(exposures['NIGHT'])
+        self.assertGreater(len(nights), 0)
+        self.assertTrue(np.all(np.diff(exposures['MJD']) > 0))
+
+        iscalib = (exposures['PROGRAM'] == b'CALIB')
+        self.assertEqual(np.count_nonzero(iscalib), 6*len(nights))
+        self.assertTrue(np.all(exposures['TILEID'][iscalib] == -1))
+        self.assertTrue(np.all(exposures['RA'].mask == iscalib))
+        self.assertTrue(np.all(np.isin(exposures['TILEID'][~iscalib], tiles['TILEID'])))
+
+    def test_results(self):
+        '''results round-trip through JSON and slower benchmarks are reported as regressions'''
+        baseline = [dict(years=1, nexposures=100, nnights=10, name='a', seconds=1.0),
+                    dict(years=1, nexposures=100, nnights=10, name='b', seconds=1.0)]
+        filename = os.path.join(self.tmpdir, 'results.json')
+        surveyqa.benchmark.write_results(filename, baseline)
+        self.assertEqual(surveyqa.benchmark.read_results(filename), baseline)
+
+        results = [dict(r) for r in baseline] + [dict(baseline[0], name='c', seconds=5.0)]
+        results[0]['seconds'] = 1.1
+        results[1]['seconds'] = 1.5
+        regressions = surveyqa.benchmark.compare_results(results, baseline, tolerance=1.2)
+        self.assertEqual(regressions, [(1, 'b', 1.5, 1.0)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Tests of surveyqa.cache
+"""
+
+import os
+import tempfile, shutil
+import unittest
+
+import numpy as np
+from astropy.table import Table
+
+import surveyqa.cache
+import surveyqa.summary
+import surveyqa.benchmark
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='surveyqa-test-')
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def test_read_cached(self):
+        '''read_cached caches the prepared table and keys it by the cache format'''
+        filename = os.path.join(self.tmpdir, 'table.fits')
+        Table(dict(A=np.arange(5), B=np.linspace(0, 1, 5))).write(filename)
+        prepare = lambda t: t[t['A'] > 1]
+
+        table = surveyqa.cache.read_cached(filename, self.cachedir, prepare)
+        cached = surveyqa.cache.read_cached(filename, self.cachedir, prepare)
+        self.assertEqual(list(cached['A']), [2, 3, 4])
+        self.assertTrue(np.all(cached['B'] == table['B']))
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+        key = surveyqa.cache.get_cache_key(filename)
+        cache_format = surveyqa.cache.cache_format
+        try:
+            surveyqa.cache.cache_format += 1
+            self.assertNotEqual(surveyqa.cache.get_cache_key(filename), key)
+        finally:
+            surveyqa.cache.cache_format = cache_format
+
+    def test_cleanup(self):
+        '''refreshing the cache of a file keeps the caches of other files and the exposures store'''
+        filename = os.path.join(self.tmpdir, 'exposures')
+        Table(dict(A=np.arange(5))).write(filename, format='fits')
+        others = ['exposures-store', 'exposures-old', 'exposures.fits-0123456789ab']
+        for d in ['exposures-0123456789ab'] + others:
+            os.makedirs(os.path.join(self.cachedir, d))
+
+        surveyqa.cache.read_cached(filename, self.cachedir, lambda t: t)
+        key = surveyqa.cache.get_cache_key(filename)
+        self.assertEqual(sorted(os.listdir(self.cachedir)), sorted(others + ['exposures-'+key]))
+
+    def test_append(self):
+        '''appends only read the new rows of the FITS file and keep the aggregates of the store up to date'''
+        tiles = surveyqa.benchmark.make_tiles(ntiles=500)
+        exposures = surveyqa.benchmark.make_exposures(tiles, 0.05)
+        nights = np.unique(exposures['NIGHT'])
+        self.assertGreaterEqual(len(nights), 2)
+        split = nights[len(nights)//2]
+        filename = os.path.join(self.tmpdir, 'exposures.fits')
+
+        exposures[exposures['NIGHT'] < split].write(filename)
+        new = surveyqa.cache.read_new_exposures(filename, self.cachedir)
+        self.assertEqual(len(new), np.count_nonzero(exposures['NIGHT'] < split))
+        surveyqa.cache.append_exposures(new, self.cachedir)
+
+        exposures.write(filename, overwrite=True)
+        new = surveyqa.cache.read_new_exposures(filename, self.cachedir)
+        self.assertTrue(np.all(new['NIGHT'] >= split))
+        chunks, added = surveyqa.cache.append_exposures(new, self.cachedir)
+        self.assertEqual(len(added), len(new))
+
+        stored = surveyqa.cache.concatenate(chunks)
+        self.assertEqual(list(stored['EXPID']), list(exposures['EXPID']))
+        tile_stats, nightly_stats = surveyqa.cache.read_exposure_stats(self.cachedir)
+        expected = surveyqa.summary.get_nightly_stats(stored)
+        self.assertEqual(list(nightly_stats['NIGHT']), list(expected['NIGHT']))
+        self.assertTrue(np.allclose(nightly_stats['SEEING'], expected['SEEING'], equal_nan=True))
+        expected = surveyqa.summary.get_tile_stats(stored)
+        self.assertEqual(list(tile_stats['TILEID']), list(expected['TILEID']))
+        self.assertEqual(list(tile_stats['LAST_ROW']), list(expected['LAST_ROW']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Tests of surveyqa.core
+"""
+
+import os, re, json
+import tempfile, shutil
+import threading
+import concurrent.futures
+import unittest
+
+import numpy as np
+import bokeh.settings
+from astropy.table import Table
+
+import surveyqa.core
+import surveyqa.nightly
+import surveyqa.timing
+
+exampledir = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'examples')
+
+class TestMakeplots(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        exposures = Table.read(os.path.join(exampledir, 'exposures.fits'))
+        tiles = Table.read(os.path.join(exampledir, 'desi-tiles.fits'))
+        cls.tiles = tiles[tiles['IN_DESI']>0]
+
+        #- A few nights with exposures of every program keep the run short
+        nights = np.unique(exposures['NIGHT'])[0:3]
+        cls.exposures = exposures[np.isin(exposures['NIGHT'], nights)]
+        cls.outdir = tempfile.mkdtemp(prefix='surveyqa-test-')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.outdir, True)
+
+    def test_summary_ids(self):
+        '''the bokeh ids of summary.html are unique when the figures are built in several workers'''
+        surveyqa.core.makeplots(self.exposures, self.tiles, self.outdir, jobs=4)
+        with open(os.path.join(self.outdir, 'summary.html')) as fp:
+            html = fp.read()
+
+        ids = re.findall(r'<div class="bk-root" id="([^"]*)"', html)
+        for docs_json in re.findall(r"docs_json = '(.*?)';\n", html):
+            #- Undo the escaping of the JSON into a javascript string
+            docs = json.loads(re.sub(r'\\(.)', r'\1', docs_json))
+            for doc in docs.values():
+                ids.extend([model['id'] for model in doc['roots']['references']])
+
+        self.assertGreater(len(ids), 0)
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_night_hashes_append(self):
+        '''adding a night doesn't change the hashes of the other nights unless the pages embed the survey histograms'''
+        exposures = surveyqa.core.add_derived_columns(self.exposures)
+        exposures = exposures[np.argsort(exposures['NIGHT'], kind='stable')]
+        lastnight = exposures['NIGHT'][-1]
+        before = exposures[exposures['NIGHT'] != lastnight]
+
+        index = surveyqa.nightly.get_night_index(exposures)
+        index_before = surveyqa.nightly.get_night_index(before)
+        hashes = surveyqa.core.get_night_hashes(exposures, index)
+        hashes_before = surveyqa.core.get_night_hashes(before, index_before)
+        self.assertEqual(len(hashes), len(hashes_before)+1)
+        for night in hashes_before:
+            self.assertEqual(hashes[night], hashes_before[night])
+
+        #- Embedded survey histograms are inputs of every page
+        hashes = surveyqa.core.get_night_hashes(exposures, index,
+            surveyqa.nightly.get_survey_hists(exposures))
+        hashes_before = surveyqa.core.get_night_hashes(before, index_before,
+            surveyqa.nightly.get_survey_hists(before))
+        for night in hashes_before:
+            self.assertNotEqual(hashes[night], hashes_before[night])
+
+    def test_incremental_append(self):
+        '''an incremental run with external data only writes the pages of added nights'''
+        outdir = tempfile.mkdtemp(prefix='surveyqa-test-')
+        try:
+            #- The histogram edges come from all exposures, so that they stay
+            #- the same when the last night is added
+            lastnight = max(self.exposures['NIGHT'])
+            nights = sorted(set(self.exposures['NIGHT']) - set([lastnight]))
+            surveyqa.core.makeplots(self.exposures, self.tiles, outdir, jobs=2, nights=nights,
+                incremental=True, external_data=True, show_summary='no')
+            pages = sorted(f for f in os.listdir(outdir) if f.startswith('night-'))
+            mtimes = [os.stat(os.path.join(outdir, f)).st_mtime_ns for f in pages]
+
+            surveyqa.core.makeplots(self.exposures, self.tiles, outdir, jobs=2,
+                incremental=True, external_data=True, show_summary='no')
+            self.assertTrue(os.path.isfile(os.path.join(outdir, 'night-{}.html'.format(lastnight))))
+            self.assertEqual(mtimes, [os.stat(os.path.join(outdir, f)).st_mtime_ns for f in pages])
+        finally:
+            shutil.rmtree(outdir, True)
+
+    def test_incremental_external(self):
+        '''incremental runs load the survey histograms from shared_data.js instead of embedding them'''
+        outdir = tempfile.mkdtemp(prefix='surveyqa-test-')
+        try:
+            night = min(self.exposures['NIGHT'])
+            surveyqa.core.makeplots(self.exposures, self.tiles, outdir, jobs=1, nights=[night],
+                incremental=True, show_summary='no')
+            self.assertTrue(os.path.isfile(os.path.join(outdir, 'shared_data.js')))
+            self.assertTrue(surveyqa.core.read_manifest(outdir)['version'].endswith('-external'))
+        finally:
+            shutil.rmtree(outdir, True)
+
+    def test_thread_pool(self):
+        '''runs in a thread pool of the caller leave its settings alone and don't share inputs'''
+        simple_ids = bokeh.settings.settings.simple_ids()
+        outdirs = [tempfile.mkdtemp(prefix='surveyqa-test-') for i in range(2)]
+        try:
+            nights = np.unique(self.exposures['NIGHT'])
+            subsets = [self.exposures[self.exposures['NIGHT'] == night] for night in nights[0:2]]
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                kwargs = [dict(pool=pool, show_summary='no',
+                               timing_report=os.path.join(outdirs[i], 'timing.json'))
+                          for i in range(2)]
+                runs = [threading.Thread(target=surveyqa.core.makeplots,
+                            args=(subsets[i], self.tiles, outdirs[i]), kwargs=kwargs[i])
+                        for i in range(2)]
+                for run in runs:
+                    run.start()
+                for run in runs:
+                    run.join()
+
+            for i in range(2):
+                pages = [f for f in os.listdir(outdirs[i]) if f.startswith('night-')]
+                self.assertEqual(pages, ['night-{}.html'.format(nights[i])])
+
+            self.assertEqual(bokeh.settings.settings.simple_ids(), simple_ids)
+            self.assertFalse(surveyqa.timing.enabled)
+        finally:
+            for outdir in outdirs:
+                shutil.rmtree(outdir, True)
+
+class TestPool(unittest.TestCase):
+
+    def test_executor_chunksize(self):
+        '''tasks run in an executor are submitted in chunks of chunksize'''
+        class Executor(concurrent.futures.ThreadPoolExecutor):
+            nsubmit = 0
+            def submit(self, *args, **kwargs):
+                Executor.nsubmit += 1
+                return super().submit(*args, **kwargs)
+
+        with Executor(2) as pool:
+            results = list(surveyqa.core._imap_unordered(pool, abs, range(-3, 4), chunksize=3))
+
+        self.assertEqual(sorted(results), [0, 1, 1, 2, 2, 3, 3])
+        self.assertEqual(Executor.nsubmit, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Tests of surveyqa.nightly
+"""
+
+import unittest
+
+import numpy as np
+from astropy.table import Table, MaskedColumn
+
+import surveyqa.nightly
+
+class TestNightly(unittest.TestCase):
+
+    def test_attribute_hist(self):
+        '''histograms leave out masked and NaN values and values outside the edges'''
+        edges = np.linspace(1.0, 2.0, 51)
+        values = MaskedColumn([0.5, 1.21, 1.21, 3.0, np.nan, 1.5], mask=[0, 0, 0, 0, 0, 1])
+        hist, hist_edges = surveyqa.nightly.get_attribute_hist(values, edges)
+        self.assertTrue(np.all(hist_edges == edges))
+
+        counts = hist * np.diff(edges) * 2
+        self.assertAlmostEqual(counts.sum(), 2)
+        self.assertAlmostEqual(counts[0], 0)
+        self.assertAlmostEqual(counts[-1], 0)
+        self.assertAlmostEqual(counts[np.searchsorted(edges, 1.21) - 1], 2)
+
+    def test_hist_edges(self):
+        '''the edges cover the science exposures with padding, and previous edges are kept while they cover them'''
+        exposures = Table(dict(
+            PROGRAM = ['DARK', 'DARK', 'CALIB', 'GRAY'],
+            AIRMASS = [1.1, 1.3, 5.0, 1.2],
+            ))
+        edges = surveyqa.nightly.get_hist_edges(exposures, attributes=['AIRMASS'])['AIRMASS']
+        self.assertEqual(len(edges), surveyqa.nightly.hist_nbins+1)
+        self.assertLess(edges[0], 1.1)
+        self.assertGreater(edges[-1], 1.3)
+        self.assertLess(edges[-1], 5.0)
+
+        more = surveyqa.nightly.get_hist_edges(exposures[0:2], attributes=['AIRMASS'],
+            previous=dict(AIRMASS=edges))
+        self.assertTrue(np.all(more['AIRMASS'] == edges))
+
+        exposures['AIRMASS'][1] = 2.5
+        wider = surveyqa.nightly.get_hist_edges(exposures, attributes=['AIRMASS'],
+            previous=dict(AIRMASS=edges))
+        self.assertGreater(wider['AIRMASS'][-1], 2.5)
+
+    def test_survey_hists(self):
+        '''the survey histograms leave out CALIB exposures and count every science exposure'''
+        exposures = Table(dict(
+            PROGRAM = ['DARK', 'DARK', 'CALIB', 'GRAY'],
+            AIRMASS = [1.1, 1.3, 5.0, 1.2],
+            ))
+        hists = surveyqa.nightly.get_survey_hists(exposures, attributes=['AIRMASS'])
+        hist, edges = hists['AIRMASS']
+        self.assertLess(edges[-1], 5.0)
+        self.assertAlmostEqual((hist * np.diff(edges)).sum(), 1)
+
+        edges = np.linspace(1.0, 2.0, 51)
+        more = surveyqa.nightly.get_survey_hists(exposures, attributes=['AIRMASS'],
+            edges=dict(AIRMASS=edges))
+        self.assertTrue(np.all(more['AIRMASS'][1] == edges))
+
+if __name__ == '__main__':
+    unittest.main()
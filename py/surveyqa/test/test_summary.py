@@ -0,0 +1,48 @@
+"""
+Tests of surveyqa.summary
+"""
+
+import os
+import unittest
+
+import numpy as np
+from astropy.table import Table
+
+import surveyqa.summary
+
+exampledir = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'examples')
+
+class TestSummary(unittest.TestCase):
+
+    def test_night_steps(self):
+        '''get_night_steps returns the first and last entry of each night'''
+        #- Three nights (changing at local noon, 19:00 UTC), the second with
+        #- a single MJD
+        mjd = np.array([58800.1, 58800.2, 58800.3, 58801.2, 58802.1, 58802.15])
+        steps = surveyqa.summary.get_night_steps(mjd)
+        self.assertEqual(list(steps), [0, 2, 3, 4, 5])
+
+        steps = surveyqa.summary.get_night_steps(mjd[0:1])
+        self.assertEqual(list(steps), [0])
+
+    def test_night_steps_empty(self):
+        '''get_night_steps returns an empty array of indices for no MJDs'''
+        steps = surveyqa.summary.get_night_steps(np.zeros(0))
+        self.assertEqual(len(steps), 0)
+        self.assertEqual(steps.dtype.kind, 'i')
+
+    def test_progress_missing_program(self):
+        '''the progress plots are made if a program has no finished tiles'''
+        exposures = Table.read(os.path.join(exampledir, 'exposures.fits'))
+        tiles = Table.read(os.path.join(exampledir, 'desi-tiles.fits'))
+        tiles = tiles[tiles['IN_DESI']>0]
+        exposures = exposures[exposures['PROGRAM'] != 'BRIGHT']
+
+        t, tile_progress, survey_progress = surveyqa.summary.get_progress(exposures, tiles, 'BRIGHT')
+        self.assertEqual(len(t), 0)
+        self.assertEqual(len(survey_progress), 0)
+
+        surveyqa.summary.get_linked_progress_plots(exposures, tiles)
+
+if __name__ == '__main__':
+    unittest.main()
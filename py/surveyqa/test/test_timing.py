@@ -0,0 +1,32 @@
+"""
+Tests of surveyqa.timing
+"""
+
+import time
+import unittest
+
+import numpy as np
+
+import surveyqa.timing
+
+class TestTiming(unittest.TestCase):
+
+    @unittest.skipIf(np.isnan(surveyqa.timing.get_rss()), 'resident memory is not available')
+    def test_stage_peak(self):
+        '''the peak memory of a stage includes memory freed before its end'''
+        with surveyqa.timing.recording():
+            surveyqa.timing.pop_records()
+            with surveyqa.timing.stage('allocate'):
+                x = np.ones(2**23)
+                time.sleep(10*surveyqa.timing.sample_interval)
+                del x
+            records = surveyqa.timing.pop_records()
+
+        self.assertEqual(len(records), 1)
+        r = records[0]
+        self.assertGreater(r['dpeak'], 32)
+        self.assertLess(r['drss'], 32)
+        self.assertGreaterEqual(r['peak'], r['rss'])
+
+if __name__ == '__main__':
+    unittest.main()
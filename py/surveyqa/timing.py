@@ -0,0 +1,245 @@
+"""
+Opt-in timing instrumentation of the QA stages
+"""
+
+import os, time
+import resource
+import threading
+import contextlib
+import json
+
+import numpy as np
+
+#- Timing is off unless enabled, so that the stages cost nothing by default
+enabled = False
+
+_records = list()
+_records_pid = os.getpid()
+_lock = threading.Lock()
+
+#- Number of active recording() blocks, and the setting from before them
+_recording = 0
+_enabled_before = False
+
+#- Records of the stages in progress, whose peak memory is sampled every
+#- sample_interval seconds by a thread started on the first stage of each
+#- process (see _start_sampler)
+sample_interval = 0.01
+_active = dict()
+_active_count = 0
+_sampler_pid = None
+_wakeup = threading.Event()
+
+def enable(flag=True):
+    '''
+    Turns the recording of stage timings on (or off if FLAG is False)
+    '''
+    global enabled
+    enabled = bool(flag)
+
+@contextlib.contextmanager
+def recording(flag=True):
+    '''
+    Context manager that turns the recording of stage timings on within its
+    block if FLAG is True, and then restores the previous setting.
+
+    Blocks may overlap, e.g. in concurrent threads; timing stays on until
+    the last of them ends.
+    '''
+    global enabled, _recording, _enabled_before
+    if not flag:
+        yield
+        return
+
+    with _lock:
+        if _recording == 0:
+            _enabled_before = enabled
+        _recording += 1
+        enabled = True
+    try:
+        yield
+    finally:
+        with _lock:
+            _recording -= 1
+            if _recording == 0:
+                enabled = _enabled_before
+
+def get_rss():
+    '''
+    Returns the current resident memory of this process in MB, or NaN if it
+    can't be read (it is read from /proc/self/statm, which is Linux only)
+    '''
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return np.nan
+
+    return pages * resource.getpagesize() / 2**20
+
+def _sample():
+    '''
+    Updates the peak memory of the stages in progress until the process
+    ends, sleeping while there are none
+    '''
+    while True:
+        _wakeup.wait()
+        rss = get_rss()
+        with _lock:
+            for record in _active.values():
+                record['peak'] = np.fmax(record['peak'], rss)
+            if len(_active) == 0:
+                _wakeup.clear()
+        time.sleep(sample_interval)
+
+def _start_sampler():
+    '''
+    Starts the thread sampling the memory of the stages in progress (see
+    _sample), once per process; a forked worker doesn't inherit the thread
+    of its parent, so it starts its own
+    '''
+    global _sampler_pid, _wakeup
+    with _lock:
+        if _sampler_pid == os.getpid():
+            return
+        _sampler_pid = os.getpid()
+        _active.clear()
+        _wakeup = threading.Event()
+
+    threading.Thread(target=_sample, name='surveyqa-timing', daemon=True).start()
+
+def _get_records():
+    '''
+    Returns the list of records of this process, dropping the records that a
+    forked worker process inherited from its parent, so that they are not
+    sent back to the parent a second time
+    '''
+    global _records, _records_pid
+    if _records_pid != os.getpid():
+        _records = list()
+        _records_pid = os.getpid()
+    return _records
+
+@contextlib.contextmanager
+def stage(name, night=None):
+    '''
+    Context manager that records the wall time and memory use of a stage
+
+    Args:
+        name: name of the stage, e.g. 'components' or 'write'
+
+    Options:
+        night: night (or 'summary') that the stage belongs to
+
+    The record has the resident memory at the end of the stage (rss), its
+    change during the stage (drss), and the peak resident memory during the
+    stage (peak) and its increase over the start of the stage (dpeak).  The
+    peak is sampled every sample_interval seconds, so shorter spikes may be
+    missed.  Memory is that of the whole process, so stages running
+    concurrently in threads of a process include each other's use.
+
+    Nothing is recorded unless timing was turned on with enable()
+    '''
+    global _active_count
+    if not enabled:
+        yield
+        return
+
+    _start_sampler()
+    start = time.time()
+    rss_start = get_rss()
+    active = dict(peak=rss_start)
+    with _lock:
+        _active_count += 1
+        key = _active_count
+        _active[key] = active
+        _wakeup.set()
+    try:
+        yield
+    finally:
+        rss = get_rss()
+        with _lock:
+            del _active[key]
+        peak = np.fmax(active['peak'], rss)
+        record = dict(stage=name, night=night, pid=os.getpid(), start=start,
+                      wall=time.time()-start, rss=rss, drss=rss-rss_start,
+                      peak=peak, dpeak=peak-rss_start)
+        with _lock:
+            _get_records().append(record)
+
+def pop_records():
+    '''
+    Returns the stage records of this process and clears them, e.g. to send
+    them from a worker process back to the parent
+    '''
+    global _records
+    with _lock:
+        records, _records = _get_records(), list()
+    return records
+
+def add_records(records):
+    '''
+    Adds stage RECORDS, e.g. returned by pop_records in a worker process
+    '''
+    with _lock:
+        _get_records().extend(records)
+
+def summarize(records):
+    '''
+    Returns per-stage statistics of RECORDS
+
+    Args:
+        records: list of stage records from pop_records
+
+    Returns list of dicts with keys stage, count, total, mean and max (wall
+    times in seconds), rss and drss (the largest resident memory at the end
+    of the stage and the largest change of resident memory during the
+    stage), and peak and dpeak (the largest peak resident memory during the
+    stage and the largest increase of it over the start of the stage), in
+    MB, sorted by decreasing total time
+    '''
+    stats = list()
+    for name in sorted(set(r['stage'] for r in records)):
+        selected = [r for r in records if r['stage'] == name]
+        wall = np.array([r['wall'] for r in selected])
+        x = dict(stage=name, count=len(wall), total=wall.sum(),
+                 mean=wall.mean(), max=wall.max())
+        for key in ['rss', 'drss', 'peak', 'dpeak']:
+            x[key] = np.max([r[key] for r in selected])
+        stats.append(x)
+
+    stats.sort(key=lambda x: -x['total'])
+    return stats
+
+def format_summary(stats):
+    '''
+    Returns a text table of the per-stage statistics from summarize
+    '''
+    lines = ['{:28s} {:>6s} {:>9s} {:>8s} {:>8s} {:>8s} {:>9s} {:>9s} {:>10s}'.format(
+        'stage', 'count', 'total[s]', 'mean[s]', 'max[s]', 'rss[MB]', 'drss[MB]', 'peak[MB]', 'dpeak[MB]')]
+    for x in stats:
+        lines.append('{:28s} {:6d} {:9.2f} {:8.3f} {:8.3f} {:8.0f} {:9.1f} {:9.0f} {:10.1f}'.format(
+            x['stage'], x['count'], x['total'], x['mean'], x['max'], x['rss'], x['drss'],
+            x['peak'], x['dpeak']))
+
+    return '\n'.join(lines)
+
+def write_report(filename, records, wall=None):
+    '''
+    Writes a JSON timing report
+
+    Args:
+        filename: output JSON file
+        records: list of stage records from pop_records
+
+    Options:
+        wall: total wall time of the run in seconds
+
+    The report has the per-stage statistics from summarize and all of the
+    individual records, so that the time of each night can be inspected
+    '''
+    report = dict(wall=wall, stages=summarize(records), records=records)
+    with open(filename, 'w') as fp:
+        json.dump(report, fp, indent=1)
+
+    print('Wrote {}'.format(filename))